@@ -1,52 +1,92 @@
+from typing import (
+    Iterable,
+)
 from dataclasses import dataclass
-from itertools import batched
 from hashlib import sha1
 import asyncio
 import random
 
 from loguru import logger as log
 
-from .metadata import Metadata
+from .files import FileIndex, Priority
+from .metadata import Metadata, TorrentFile
+from .peer.handshake import FAST_EXTENSION
 from .peer.peer import Peer
+from .picker import PiecePicker
+from .streaming import TorrentFileReader
+from .utils import allowed_fast_set
+from .utp import UtpSocket
 import p2pyrate.peer.message as pm
 
 
 
+BLOCK_SIZE = 64*2**3
+
+
 class TorrentPiece:
-    def __init__(self, index: int, hash: bytes, size: int) -> None:
+    def __init__(self, index: int, hash: bytes, size: int, data: bytearray|memoryview|None=None) -> None:
         self.index = index
         self.hash: bytes = hash
         self.size: int = size
-        self.data: bytearray = bytearray(b"\x00" * size)
-        self.missing: list[bool] = [True] * size
+        assert data is None or len(data) == size
+        # Allocated on first use, pieces that are never downloaded cost nothing
+        self._data: bytearray|memoryview|None = data
+        self.n_blocks: int = -(-size // BLOCK_SIZE)
+        self.missing: list[bool] = [True] * self.n_blocks
+
+    @property
+    def data(self) -> bytearray|memoryview:
+        if self._data is None:
+            self._data = bytearray(self.size)
+        return self._data
+
+    @property
+    def allocated(self) -> bool:
+        return self._data is not None
 
     @property
     def complete(self) -> bool:
         return not any(self.missing)
 
+    def verify(self) -> bool:
+        return sha1(self.data).digest()==self.hash
+
+    def mark_complete(self):
+        self.missing = [False] * self.n_blocks
+
+    def reset(self):
+        self.missing = [True] * self.n_blocks
+
     def set_complete_data(self, data: bytes):
         assert sha1(data).digest()==self.hash
-        self.data = bytearray(data)
-        self.missing = [False] * self.size
+        self.data[:] = data
+        self.mark_complete()
 
     def add_block(self, begin: int, block: bytes):
         assert begin+len(block) <= self.size
-        self.data[begin:begin+len(block)] = block
-        self.missing[begin:begin+len(block)] = [False] * len(block)
+        end = begin + len(block)
+        self.data[begin:end] = block
+        # Only blocks covered entirely count as received
+        first = -(-begin // BLOCK_SIZE)
+        last = self.n_blocks if end == self.size else end // BLOCK_SIZE
+        self.missing[first:last] = [False] * max(0, last-first)
 
-    def missing_blocks(self, block_size: int=64*2**3) -> list[tuple[int,int,int]]:
-        outp = []
-        for i,b in enumerate(batched(self.missing, block_size)):
-            if any(b):
-                outp.append((self.index,i*block_size,block_size))
-        return outp
+    def blocks(self) -> list[tuple[int,int,int]]:
+        return [(self.index, begin, min(BLOCK_SIZE, self.size-begin)) for begin in range(0, self.size, BLOCK_SIZE)]
+
+    def missing_blocks(self) -> list[tuple[int,int,int]]:
+        return [b for b,missing in zip(self.blocks(), self.missing) if missing]
 
 
 @dataclass
 class CompletePiece:
     index: int
 
-ClientEvent_T = CompletePiece
+@dataclass
+class PrioritiesChanged:
+    pass
+
+ClientEvent_T = CompletePiece|PrioritiesChanged
 
 @dataclass
 class Event:
@@ -55,130 +95,371 @@ class Event:
 
     
 
+def random_peer_id() -> bytes:
+    return ("XX-" + "".join(f"{random.randint(0,9)}" for _ in range(17))).encode("utf-8")
+
+
 class Downloader:
-    def __init__(self, metadata: Metadata, peer_id: bytes|None=None) -> None:
+    def __init__(self, metadata: Metadata, peer_id: bytes|None=None, storage: memoryview|None=None) -> None:
         if peer_id is None:
-            peer_id = ("XX-" + "".join(f"{random.randint(0,9)}" for _ in range(17))).encode("utf-8")
+            peer_id = random_peer_id()
         self.metadata = metadata
         self.peer_id: bytes = peer_id
         self.info_hash: bytes = metadata.info.hash
         self.piece_length: int = metadata.info.piece_length
         self.trackers = [metadata.announce.decode(),*[a[0].decode() for a in metadata[b"announce-list"]]]
         self.peers: dict[bytes,Peer] = {}
-        self.pieces: list[TorrentPiece] = [TorrentPiece(index=idx, hash=p, size=self.piece_length) for idx,p in enumerate(metadata.info.pieces)]
+        total_length = metadata.info.total_length
+        if storage is not None:
+            assert len(storage) == total_length
+        self.pieces: list[TorrentPiece] = []
+        for idx,p in enumerate(metadata.info.pieces):
+            start = idx*self.piece_length
+            size = min(self.piece_length, total_length-start)
+            data = storage[start:start+size] if storage is not None else None
+            self.pieces.append(TorrentPiece(index=idx, hash=p, size=size, data=data))
+        self.file_index = FileIndex(metadata.info)
+        self.picker = PiecePicker(len(self.pieces))
+        self.picker.priority = list(self.file_index.piece_priorities())
+        self.max_requested_pieces: int = 4
+        self.extensions: bytes = FAST_EXTENSION.to_bytes(8)
+        self.allowed_fast_count: int = 10
+        # Streaming mode, pieces within read_ahead of the cursor piece go first
+        self.read_ahead: int|None = None
+        self.cursor: int = 0
+        self.piece_waiters: dict[int,list[asyncio.Future]] = {}
         self.event_q: asyncio.Queue[Event] = asyncio.Queue()
+        self.utp: UtpSocket|None = None
 
     @property
     def have(self) -> list[bool]:
         return [p.complete for p in self.pieces]
 
+    @property
+    def done(self) -> bool:
+        # Not based on wanted, which workers narrow to their assigned pieces
+        return all(p.complete or not self.picker.priority[p.index] for p in self.pieces)
+
+    def wanted(self, index: int) -> bool:
+        return self.picker.priority[index] > 0 and not self.pieces[index].complete
+
+    def piece_order(self, index: int, suggested: set[int]=set()) -> tuple:
+        if self.read_ahead is not None and 0 <= (distance := index - self.cursor) < self.read_ahead:
+            return (0, distance)
+        return (1, -self.picker.priority[index], index not in suggested, *self.picker.rarest_first(index))
+
+    def can_request(self, peer: Peer) -> bool:
+        return not peer.choked or bool(peer.allowed_fast)
+
+    def can_request_piece(self, peer: Peer, index: int) -> bool:
+        return index in peer.pieces and index not in peer.rejected and (not peer.choked or index in peer.allowed_fast)
+
+    def pick(self, peer: Peer, n: int) -> list[int]:
+        if n <= 0:
+            return []
+        available = peer.pieces if not peer.choked else peer.pieces & peer.allowed_fast
+        candidates = [i for i in available if i not in peer.requested and i not in peer.rejected and self.wanted(i)]
+        key = lambda i: self.piece_order(i, peer.suggested)
+        if picked := self.picker.pick(peer.peer_id, candidates, n, key=key):
+            return picked
+        # Endgame, everything this peer has is already requested from others
+        return sorted(candidates, key=key)[:n]
+
+    def drop_requests(self, peer: Peer, indices: Iterable[int]):
+        for index in list(indices):
+            peer.requested.discard(index)
+            if self.picker.assigned.get(index) == peer.peer_id:
+                self.picker.release([index])
+
+    async def request_pieces(self, peer: Peer):
+        if not self.can_request(peer):
+            return
+        # Cursor pieces requested by move_cursor can push a peer over the limit
+        for index in self.pick(peer, max(0, self.max_requested_pieces - len(peer.requested))):
+            peer.requested.add(index)
+            for b in self.pieces[index].missing_blocks():
+                await peer.write(pm.Request.from_block(*b))
+
+    def peer_has(self, peer: Peer, indices: list[int]):
+        new = [i for i in indices if i not in peer.pieces]
+        peer.pieces.update(new)
+        self.picker.add_available(new)
+
+    def peer_closed(self, peer: Peer):
+        if peer.peer_id is not None and self.peers.get(peer.peer_id) is peer:
+            del self.peers[peer.peer_id]
+            self.picker.add_available(peer.pieces, delta=-1)
+            self.picker.release_owner(peer.peer_id)
+
+    async def piece_completed(self, index: int):
+        if not self.pieces[index].verify():
+            log.warning("hash mismatch for piece {}", index)
+            self.pieces[index].reset()
+            self.picker.release([index])
+            return
+        self.picker.mark_have(index)
+        for f in self.piece_waiters.pop(index, []):
+            if not f.done():
+                f.set_result(None)
+        await self.event_q.put(Event(peer_id=self.peer_id, message=CompletePiece(index=index)))
+
+    async def wait_piece(self, index: int):
+        if self.pieces[index].complete:
+            return
+        f = asyncio.get_running_loop().create_future()
+        self.piece_waiters.setdefault(index, []).append(f)
+        await f
+
+    async def move_cursor(self, offset: int):
+        # Reading up to the end of the torrent leaves the offset one past its last piece
+        cursor = min(offset // self.piece_length, len(self.pieces) - 1)
+        if cursor == self.cursor or self.read_ahead is None:
+            self.cursor = cursor
+            return
+        self.cursor = cursor
+        if self.wanted(cursor):
+            # The reader is blocked on this piece, ask every peer that has it
+            for peer in list(self.peers.values()):
+                if cursor not in peer.requested and self.can_request_piece(peer, cursor):
+                    peer.requested.add(cursor)
+                    for b in self.pieces[cursor].missing_blocks():
+                        await peer.write(pm.Request.from_block(*b))
+
+    def open(self, file: int|TorrentFile=0, read_ahead: int|None=None) -> TorrentFileReader:
+        index = self.file_index.index(file)
+        if read_ahead is not None or self.read_ahead is None:
+            self.read_ahead = read_ahead or 8
+        return TorrentFileReader(self, self.file_index.offsets[index], self.file_index.files[index].length)
+
+    async def set_file_priorities(self, priorities: dict[int|TorrentFile,Priority]):
+        for index in self.file_index.set_priorities(priorities):
+            self.picker.priority[index] = self.file_index.piece_priority(index)
+        # Skipping the last missing pieces completes the torrent
+        await self.event_q.put(Event(peer_id=self.peer_id, message=PrioritiesChanged()))
+        for peer in list(self.peers.values()):
+            # Blocks of pieces that became skipped are not worth waiting for
+            skipped = [i for i in peer.requested if not self.wanted(i)]
+            for index in skipped:
+                for b in self.pieces[index].missing_blocks():
+                    await peer.write(pm.Cancel.from_block(*b))
+            self.drop_requests(peer, skipped)
+            await self.update_interest(peer)
+            await self.request_pieces(peer)
+
+    async def set_file_priority(self, file: int|TorrentFile, priority: Priority):
+        await self.set_file_priorities({file: priority})
+
+
+    async def grant_fast(self, peer: Peer):
+        if not peer.fast:
+            return
+        # Only advertise pieces the peer can actually get from us
+        for index in allowed_fast_set(peer.host, self.info_hash, len(self.pieces), self.allowed_fast_count):
+            if self.pieces[index].complete:
+                peer.granted_fast.add(index)
+                await peer.write(pm.AllowedFast.from_index(index))
+
+    async def serve_uploads(self, peer: Peer):
+        while True:
+            await peer.upload_ready.wait()
+            while peer.uploads:
+                index, begin, size = peer.uploads.popleft()
+                await peer.write(pm.Piece.from_block(index, begin, self.pieces[index].data[begin:begin+size]))
+            peer.upload_ready.clear()
 
     async def handle_peer(self, peer: Peer, outbound: bool):
-        log.info(f"connection made to {peer}")
-        hs = await peer.handshake(self.info_hash, self.peer_id, outbound)
-        log.info(f"handshake made to {peer}")
+        log.info("connection made to {}", peer)
+        hs = await peer.handshake(self.info_hash, self.peer_id, outbound, self.extensions)
+        log.info("handshake made to {}", peer)
         assert hs.info_hash == self.info_hash
         assert peer.peer_id is not None
+        if peer.peer_id in self.peers:
+            # Events are dispatched by peer id, keep the first connection
+            log.info("already connected to {}", peer)
+            await peer.close()
+            return
         self.peers[peer.peer_id] = peer
-        if any(self.have):
-            await peer.send_bitfield(self.have)
+        await peer.send_bitfield(self.have)
+        await self.grant_fast(peer)
         await peer.unchoke()
-        while True:
-            message = await peer.read()
-            await self.event_q.put(Event(peer_id=peer.peer_id, message=message))
-        await peer.close()
+        uploads = asyncio.create_task(self.serve_uploads(peer))
+        try:
+            while True:
+                message = await peer.read()
+                await self.event_q.put(Event(peer_id=peer.peer_id, message=message))
+        except (asyncio.IncompleteReadError, ConnectionError):
+            log.info("connection lost to {}", peer)
+        finally:
+            uploads.cancel()
+            self.peer_closed(peer)
+            await peer.close()
+
+    async def update_interest(self, peer: Peer):
+        interested = any(self.wanted(idx) for idx in peer.pieces)
+        if interested != peer.am_interested:
+            peer.am_interested = interested
+            await peer.write(pm.Interested() if interested else pm.NotInterested())
+
+    async def peer_announced(self, peer: Peer):
+        await self.update_interest(peer)
+        if peer.am_interested:
+            await self.request_pieces(peer)
 
 
     async def handle_events(self):
         while True:
             e = await self.event_q.get()
-            peer = self.peers.get(e.peer_id)
             # Client Events
-            if peer is None:
+            if e.peer_id == self.peer_id:
                 match e.message:
                     case CompletePiece(index):
-                        if all(p.complete for p in self.pieces):
+                        if self.done:
                             return
                         await asyncio.gather(*(p.write(pm.Have.from_index(index)) for p in self.peers.values()))
-                    
+
+                    case PrioritiesChanged():
+                        if self.done:
+                            return
+
                     case _ as m:
                         raise ValueError(f"unexpected message {m}")
 
                 continue
-            # Peer events
+            # Peer events, the ones queued before the peer disconnected are dropped
+            if (peer := self.peers.get(e.peer_id)) is None:
+                continue
             match e.message:
                 case pm.Choke():
                     peer.choked = True
+                    # A fast peer rejects each request it drops, the others drop all of them silently
+                    if not peer.fast:
+                        self.drop_requests(peer, peer.requested)
 
                 case pm.Unchoke():
                     peer.choked = False
-                    for idx in peer.pieces:
-                        if not (piece := self.pieces[idx]).complete:
-                            for b in piece.missing_blocks():
-                                await peer.write(pm.Request.from_block(*b))
+                    peer.rejected.clear()
+                    await self.request_pieces(peer)
 
-                case pm.Interested:
+                case pm.Interested():
                     peer.interested = True
 
-                case pm.NotInterested:
+                case pm.NotInterested():
                     peer.interested = False
 
                 case pm.Have() as m:
-                    peer.pieces.add(m.index)
-                    if not (piece := self.pieces[m.index]).complete:
-                        if peer.choked:
-                            await peer.write(pm.Interested())
-                        else:
-                            for b in piece.missing_blocks():
-                                await peer.write(pm.Request.from_block(*b))
+                    self.peer_has(peer, [m.index])
+                    await self.peer_announced(peer)
 
                 case pm.Bitfield() as m:
-                    for index,has in enumerate(m.bool_list[:len(self.pieces)]):
-                        if has:
-                            peer.pieces.add(index)
-                    if any((not self.pieces[idx].complete) for idx in peer.pieces):
-                        if peer.choked:
-                            await peer.write(pm.Interested())
-                        else:
-                            for idx in peer.pieces:
-                                if not (piece := self.pieces[idx]).complete:
-                                    for b in piece.missing_blocks():
-                                        await peer.write(pm.Request.from_block(*b))
+                    self.peer_has(peer, [index for index,has in enumerate(m.bool_list[:len(self.pieces)]) if has])
+                    await self.peer_announced(peer)
+
+                case pm.HaveAll():
+                    self.peer_has(peer, list(range(len(self.pieces))))
+                    await self.peer_announced(peer)
+
+                case pm.HaveNone():
+                    pass
 
                 case pm.Request() as m:
                     index, begin, size = m.data
-                    if not self.pieces[index].missing[begin]:
-                        piece = self.pieces[index]
-                        await peer.write(pm.Piece.from_block(index, begin, piece.data[begin:begin+piece.size]))
-                    
+                    if peer.am_choking and index not in peer.granted_fast:
+                        await peer.reject(index, begin, size)
+                    elif self.pieces[index].complete:
+                        peer.queue_upload(index, begin, size)
+                    else:
+                        await peer.reject(index, begin, size)
+
+                case pm.Cancel() as m:
+                    await peer.cancel_upload(*m.message)
+
+                case pm.RejectRequest() as m:
+                    index, begin, size = m.data
+                    # Do not ask this peer for it again
+                    peer.allowed_fast.discard(index)
+                    peer.rejected.add(index)
+                    if index not in peer.requested or self.pieces[index].complete:
+                        continue
+                    # Only the rejected block moves, the other blocks asked from this peer may still come
+                    others = [p for p in self.peers.values() if p is not peer and self.can_request_piece(p, index)]
+                    if others:
+                        other = min(others, key=lambda p: len(p.requested))
+                        other.requested.add(index)
+                        await other.write(pm.Request.from_block(index, begin, size))
+                    else:
+                        # Nobody can serve it now, the piece goes back to the picker
+                        for p in self.peers.values():
+                            self.drop_requests(p, [index])
+                        self.picker.release([index])
+
+                case pm.AllowedFast() as m:
+                    if m.index < len(self.pieces):
+                        peer.allowed_fast.add(m.index)
+                        if peer.choked and m.index in peer.pieces:
+                            await self.request_pieces(peer)
+
+                case pm.SuggestPiece() as m:
+                    if m.index < len(self.pieces) and self.wanted(m.index):
+                        peer.suggested.add(m.index)
 
                 case pm.Piece() as m:
                     index,begin,block = m.data
+                    if self.pieces[index].complete:
+                        continue
                     self.pieces[index].add_block(begin, block)
                     if self.pieces[index].complete:
-                        await self.event_q.put(Event(peer_id=self.peer_id, message=CompletePiece(index=index)))
+                        await self.piece_completed(index)
+                        for p in list(self.peers.values()):
+                            p.suggested.discard(index)
+                            if index in p.requested:
+                                p.requested.discard(index)
+                                if p is not peer:
+                                    # Endgame duplicates
+                                    for b in self.pieces[index].blocks():
+                                        await p.write(pm.Cancel.from_block(*b))
+                                await self.request_pieces(p)
 
                 case _ as m:
                     raise ValueError(f"unexpected message {m}")
 
-    async def add_peer(self, host: str, port: int):
-        reader, writer = await asyncio.wait_for(
-            asyncio.open_connection(host, port),
-            timeout=10
-        )
+    async def add_peer(self, host: str, port: int, utp: bool=False):
+        if utp:
+            sock = self.utp or await self.listen_utp()
+            connection = sock.open_connection(host, port)
+        else:
+            connection = asyncio.open_connection(host, port)
+        reader, writer = await asyncio.wait_for(connection, timeout=10)
         peer = Peer(host=host, port=port,_reader=reader, _writer=writer)
         await self.handle_peer(peer, outbound=True)
 
 
-    async def start_server(self, port: int|None=None):
+    async def listen(self, port: int|None=None, reuse_port: bool=False) -> asyncio.Server:
         server = await asyncio.start_server(
-            lambda r,w: self.handle_peer(Peer.from_streams(r,w), outbound=False), '127.0.0.1', port
+            lambda r,w: self.handle_peer(Peer.from_streams(r,w), outbound=False), '127.0.0.1', port, reuse_port=reuse_port
         )
         addr = server.sockets[0].getsockname()
-        log.info(f'Listening on {addr}')
+        log.info("Listening on {}", addr)
+        return server
+
+    def use_utp(self, sock: UtpSocket):
+        # Incoming and outgoing uTP connections share one socket
+        self.utp = sock
+        sock.serve(lambda r,w: self.handle_peer(Peer.from_streams(r,w), outbound=False))
+
+    async def listen_utp(self, port: int|None=None) -> UtpSocket:
+        sock = await UtpSocket.bind('127.0.0.1', port)
+        self.use_utp(sock)
+        log.info("Listening for uTP on {}", sock.sockname)
+        return sock
+
+    async def start_server(self, port: int|None=None, reuse_port: bool=False, utp: bool=False):
+        server = await self.listen(port, reuse_port=reuse_port)
+        if utp and self.utp is None:
+            # Same port number as TCP, like other clients do
+            await self.listen_utp(server.sockets[0].getsockname()[1])
         async with server:
             await server.serve_forever()
 
 
-    async def start(self, port: int|None=None):
-        await asyncio.gather(*(self.start_server(port=port), self.handle_events()))
+    async def start(self, port: int|None=None, utp: bool=False):
+        await asyncio.gather(*(self.start_server(port=port, utp=utp), self.handle_events()))
@@ -0,0 +1,50 @@
+from bisect import bisect_right
+from enum import IntEnum
+from itertools import accumulate
+
+from .metadata import TorrentInfo, TorrentFile
+
+
+class Priority(IntEnum):
+    SKIP = 0
+    LOW = 1
+    NORMAL = 4
+    HIGH = 7
+
+
+class FileIndex:
+    def __init__(self, info: TorrentInfo) -> None:
+        self.files: list[TorrentFile] = info.files
+        self.piece_length: int = info.piece_length
+        self.n_pieces: int = len(info.pieces)
+        self.offsets: list[int] = [0, *accumulate(f.length for f in self.files)][:-1]
+        # Pieces overlapping each file, boundary pieces belong to both neighbours
+        self.pieces: list[range] = [
+            range(offset // self.piece_length, -(-(offset + f.length) // self.piece_length)) if f.length else range(0)
+            for offset,f in zip(self.offsets, self.files)
+        ]
+        self.priorities: list[Priority] = [Priority.NORMAL] * len(self.files)
+
+    def index(self, file: int|TorrentFile) -> int:
+        return file if isinstance(file, int) else self.files.index(file)
+
+    def files_of_piece(self, index: int) -> range:
+        start = index * self.piece_length
+        return range(max(0, bisect_right(self.offsets, start) - 1), bisect_right(self.offsets, start + self.piece_length - 1))
+
+    def piece_priority(self, index: int) -> Priority:
+        return max((self.priorities[f] for f in self.files_of_piece(index) if index in self.pieces[f]), default=Priority.SKIP)
+
+    def piece_priorities(self) -> list[Priority]:
+        return [self.piece_priority(i) for i in range(self.n_pieces)]
+
+    def set_priority(self, file: int|TorrentFile, priority: Priority) -> list[int]:
+        index = self.index(file)
+        self.priorities[index] = priority
+        return list(self.pieces[index])
+
+    def set_priorities(self, priorities: dict[int|TorrentFile,Priority]) -> list[int]:
+        changed: set[int] = set()
+        for file,priority in priorities.items():
+            changed.update(self.set_priority(file, priority))
+        return sorted(changed)
@@ -23,10 +23,23 @@ class TorrentInfo(dict):
     def length(self) -> int|None:
         return self.get(b"length")
 
+    @property
+    def name(self) -> bytes:
+        return self[b"name"]
+
     @property
     def files(self) -> list[TorrentFile]:
+        if (length := self.length) is not None:
+            # Single file torrents describe their only file in the info dictionary
+            return [TorrentFile({b"length": length, b"path": [self.name]})]
         return [TorrentFile(_) for _ in self[b"files"]]
 
+    @property
+    def total_length(self) -> int:
+        if (length := self.length) is not None:
+            return length
+        return sum(f.length for f in self.files)
+
     @property
     def hash(self) -> bytes:
         return hashlib.sha1(bencode2.bencode(self)).digest()
@@ -11,6 +11,11 @@ __all__ = [
     "Request",
     "Piece",
     "Cancel",
+    "SuggestPiece",
+    "HaveAll",
+    "HaveNone",
+    "RejectRequest",
+    "AllowedFast",
     "PeerMessage_T",
 ]
 
@@ -30,5 +35,10 @@ from .message import (
     Request,
     Piece,
     Cancel,
+    SuggestPiece,
+    HaveAll,
+    HaveNone,
+    RejectRequest,
+    AllowedFast,
     PeerMessage_T,
 )
@@ -10,6 +10,10 @@ import struct
 import bencode2
 
 
+# Reserved handshake bits, counted from the least significant bit of the last byte
+FAST_EXTENSION = 1 << 2
+EXTENSION_PROTOCOL = 1 << 20
+
 
 @dataclass
 class MetadataProtocolInfo:
@@ -96,4 +100,8 @@ class Handshake:
 
     @property
     def extended_support(self) -> bool:
-        return int.from_bytes(self.extensions) & (1<<20) > 1
+        return int.from_bytes(self.extensions) & EXTENSION_PROTOCOL > 0
+
+    @property
+    def fast_support(self) -> bool:
+        return int.from_bytes(self.extensions) & FAST_EXTENSION > 0
@@ -7,7 +7,23 @@ import struct
 
 from ..utils import bitfield_to_bl, bl_to_bitfield
 
-__all__ = ["Choke", "Unchoke", "Interested", "NotInterested", "Have", "Bitfield", "Request", "Piece", "Cancel", "PeerMessage_T"]
+__all__ = [
+    "Choke",
+    "Unchoke",
+    "Interested",
+    "NotInterested",
+    "Have",
+    "Bitfield",
+    "Request",
+    "Piece",
+    "Cancel",
+    "SuggestPiece",
+    "HaveAll",
+    "HaveNone",
+    "RejectRequest",
+    "AllowedFast",
+    "PeerMessage_T",
+]
 
 
 @dataclass
@@ -100,9 +116,73 @@ class Cancel:
     payload: bytes
     message_id: Literal[8] = 8
 
+    @classmethod
+    def from_block(cls, index, begin, length) -> Self:
+        return cls(
+            payload=struct.pack("!III", index, begin, length)
+        )
+
     @property
     def message(self) -> tuple[int,int,int]:
-        ...
+        return struct.unpack("!III", self.payload)
+
+
+# Fast extension (BEP 6)
+
+@dataclass
+class SuggestPiece:
+    payload: bytes
+    message_id: Literal[13] = 13
+
+    @classmethod
+    def from_index(cls, index: int) -> Self:
+        return cls(
+            payload=struct.pack("!I", index)
+        )
+
+    @property
+    def index(self) -> int:
+        return struct.unpack("!I", self.payload)[0]
+
+@dataclass
+class HaveAll:
+    payload: Literal[b""] = b""
+    message_id: Literal[14] = 14
+
+@dataclass
+class HaveNone:
+    payload: Literal[b""] = b""
+    message_id: Literal[15] = 15
+
+@dataclass
+class RejectRequest:
+    payload: bytes
+    message_id: Literal[16] = 16
+
+    @classmethod
+    def from_block(cls, index, begin, length) -> Self:
+        return cls(
+            payload=struct.pack("!III", index, begin, length)
+        )
+
+    @property
+    def data(self) -> tuple[int,int,int]:
+        return struct.unpack("!III", self.payload)
+
+@dataclass
+class AllowedFast:
+    payload: bytes
+    message_id: Literal[17] = 17
+
+    @classmethod
+    def from_index(cls, index: int) -> Self:
+        return cls(
+            payload=struct.pack("!I", index)
+        )
+
+    @property
+    def index(self) -> int:
+        return struct.unpack("!I", self.payload)[0]
 
 
-PeerMessage_T = Choke|Unchoke|Interested|NotInterested|Have|Bitfield|Request|Piece|Cancel
+PeerMessage_T = Choke|Unchoke|Interested|NotInterested|Have|Bitfield|Request|Piece|Cancel|SuggestPiece|HaveAll|HaveNone|RejectRequest|AllowedFast
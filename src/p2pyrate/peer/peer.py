@@ -1,10 +1,10 @@
-from asyncio import StreamReader, StreamWriter
+from asyncio import Event, StreamReader, StreamWriter
+from collections import deque
 from dataclasses import dataclass, field
 import struct
 
-from loguru import logger as log
-
-from .handshake import Handshake
+from .. import trace
+from .handshake import Handshake, FAST_EXTENSION
 from .message import (
     Choke,
     Unchoke,
@@ -15,6 +15,11 @@ from .message import (
     Request,
     Piece,
     Cancel,
+    SuggestPiece,
+    HaveAll,
+    HaveNone,
+    RejectRequest,
+    AllowedFast,
     PeerMessage_T,
 )
 
@@ -26,9 +31,27 @@ class Peer:
     _reader: StreamReader = field(repr=False)
     _writer: StreamWriter = field(repr=False)
     peer_id: bytes|None = None
+    # Whether the peer chokes us, and whether we choke the peer
     choked: bool = True
+    am_choking: bool = True
+    # Whether the peer is interested in us, and whether we are interested in the peer
     interested: bool = False
+    am_interested: bool = False
+    # Both sides advertised the fast extension
+    fast: bool = False
     pieces: set[int] = field(repr=False, default_factory=lambda: set())
+    requested: set[int] = field(repr=False, default_factory=lambda: set())
+    # Pieces the peer lets us request while choked, and the ones we let it request
+    allowed_fast: set[int] = field(repr=False, default_factory=lambda: set())
+    granted_fast: set[int] = field(repr=False, default_factory=lambda: set())
+    suggested: set[int] = field(repr=False, default_factory=lambda: set())
+    # Pieces the peer rejected a request for, not asked for again until it unchokes us
+    rejected: set[int] = field(repr=False, default_factory=lambda: set())
+    # Requests received and not answered yet
+    uploads: deque[tuple[int,int,int]] = field(repr=False, default_factory=lambda: deque())
+    upload_ready: Event = field(repr=False, default_factory=lambda: Event())
+    # The connection dropped, the read side notices it and tears the peer down
+    closed: bool = False
 
 
     @classmethod
@@ -41,49 +64,86 @@ class Peer:
             _writer=writer,
         )
 
-    async def handshake(self, info_hash: bytes, peer_id: bytes, outbound: bool) -> Handshake:
+    async def handshake(self, info_hash: bytes, peer_id: bytes, outbound: bool, extensions: bytes=b"\x00") -> Handshake:
         if outbound:
-            hs = await self.send_handshake(info_hash=info_hash, peer_id=peer_id)
+            hs = await self.send_handshake(info_hash=info_hash, peer_id=peer_id, extensions=extensions)
         else:
-            hs = await self.receive_handshake(info_hash=info_hash, peer_id=peer_id)
+            hs = await self.receive_handshake(info_hash=info_hash, peer_id=peer_id, extensions=extensions)
         self.peer_id = hs.peer_id
+        self.fast = hs.fast_support and int.from_bytes(extensions) & FAST_EXTENSION > 0
         return hs
 
-    async def receive_handshake(self, info_hash: bytes, peer_id: bytes) -> Handshake:
+    async def receive_handshake(self, info_hash: bytes, peer_id: bytes, extensions: bytes=b"\x00") -> Handshake:
         hs = await Handshake.from_reader(self._reader)
-        self._writer.write(Handshake(info_hash=info_hash, peer_id=peer_id).to_bytes())
+        self._writer.write(Handshake(info_hash=info_hash, extensions=extensions, peer_id=peer_id).to_bytes())
         await self._writer.drain()
         return hs
 
-    async def send_handshake(self, info_hash: bytes, peer_id: bytes) -> Handshake:
-        self._writer.write(Handshake(info_hash=info_hash, peer_id=peer_id).to_bytes())
+    async def send_handshake(self, info_hash: bytes, peer_id: bytes, extensions: bytes=b"\x00") -> Handshake:
+        self._writer.write(Handshake(info_hash=info_hash, extensions=extensions, peer_id=peer_id).to_bytes())
         await self._writer.drain()
         hs = await Handshake.from_reader(self._reader)
         return hs
 
     async def choke(self):
         await self.write(Choke())
-        self.choked = True
+        self.am_choking = True
+        # Queued replies are dropped, fast peers are told so instead of having to time out
+        for request in [r for r in self.uploads if r[0] not in self.granted_fast]:
+            self.uploads.remove(request)
+            await self.reject(*request)
 
     async def unchoke(self):
         await self.write(Unchoke())
-        self.choked = False
+        self.am_choking = False
 
     async def send_bitfield(self, have: list[bool]):
-        await self.write(Bitfield.from_bool_list(have))
+        if self.fast and all(have):
+            await self.write(HaveAll())
+        elif self.fast and not any(have):
+            await self.write(HaveNone())
+        elif any(have):
+            await self.write(Bitfield.from_bool_list(have))
+
+    async def reject(self, index: int, begin: int, length: int):
+        if self.fast:
+            await self.write(RejectRequest.from_block(index, begin, length))
+
+    def queue_upload(self, index: int, begin: int, length: int):
+        self.uploads.append((index, begin, length))
+        self.upload_ready.set()
+
+    async def cancel_upload(self, index: int, begin: int, length: int):
+        try:
+            self.uploads.remove((index, begin, length))
+        except ValueError:
+            # Already sent
+            return
+        await self.reject(index, begin, length)
 
     async def read(self) -> PeerMessage_T:
         message = await read_message(self._reader)
-        log.debug(f"read {message.message_id} from {self.peer_id}")
+        if trace.tracer is not None:
+            trace.tracer.record(trace.READ, (self.host, self.port), message.message_id, len(message.payload))
         return message
     
     async def write(self, message: PeerMessage_T):
-        log.debug(f"write {message.message_id} to {self.peer_id}")
-        return await write_message(self._writer, message)
+        if self.closed:
+            return
+        if trace.tracer is not None:
+            trace.tracer.record(trace.WRITE, (self.host, self.port), message.message_id, len(message.payload))
+        try:
+            await write_message(self._writer, message)
+        except ConnectionError:
+            self.closed = True
 
     async def close(self):
+        self.closed = True
         self._writer.close()
-        await self._writer.wait_closed()
+        try:
+            await self._writer.wait_closed()
+        except ConnectionError:
+            pass
 
 
 async def read_message(reader: StreamReader) -> PeerMessage_T:
@@ -111,6 +171,16 @@ async def read_message(reader: StreamReader) -> PeerMessage_T:
             return Piece(payload=payload)
         case 8:
             return Cancel(payload=payload)
+        case 13:
+            return SuggestPiece(payload=payload)
+        case 14:
+            return HaveAll()
+        case 15:
+            return HaveNone()
+        case 16:
+            return RejectRequest(payload=payload)
+        case 17:
+            return AllowedFast(payload=payload)
         case _:
             raise ValueError(f"unexpected message id: {message_id}")
 
@@ -0,0 +1,53 @@
+from typing import (
+    Any,
+    Callable,
+    Hashable,
+    Iterable,
+)
+
+
+class PiecePicker:
+    def __init__(self, n_pieces: int, have: Iterable[bool]|None=None) -> None:
+        self.n_pieces = n_pieces
+        self.have: set[int] = {i for i,h in enumerate(have or []) if h}
+        self.availability: list[int] = [0] * n_pieces
+        # Pieces with a zero priority are never picked
+        self.priority: list[int] = [1] * n_pieces
+        self.assigned: dict[int,Hashable] = {}
+
+    @property
+    def complete(self) -> bool:
+        return all(i in self.have for i,p in enumerate(self.priority) if p)
+
+    def add_available(self, indices: Iterable[int], delta: int=1):
+        for i in indices:
+            self.availability[i] += delta
+
+    def rarest_first(self, index: int) -> tuple[int,int]:
+        # The index keeps the order deterministic
+        return self.availability[index], index
+
+    def priority_first(self, index: int) -> tuple[int,int,int]:
+        return -self.priority[index], *self.rarest_first(index)
+
+    def pick(self, owner: Hashable, candidates: Iterable[int], n: int, key: Callable[[int],Any]|None=None) -> list[int]:
+        if n <= 0:
+            return []
+        free = [i for i in candidates if self.priority[i] and i not in self.have and i not in self.assigned]
+        picked = sorted(free, key=key or self.priority_first)[:n]
+        for i in picked:
+            self.assigned[i] = owner
+        return picked
+
+    def release(self, indices: Iterable[int]):
+        for i in indices:
+            self.assigned.pop(i, None)
+
+    def release_owner(self, owner: Hashable) -> list[int]:
+        released = [i for i,o in self.assigned.items() if o == owner]
+        self.release(released)
+        return released
+
+    def mark_have(self, index: int):
+        self.have.add(index)
+        self.assigned.pop(index, None)
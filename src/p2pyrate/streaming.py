@@ -0,0 +1,63 @@
+from typing import (
+    TYPE_CHECKING,
+)
+import os
+
+if TYPE_CHECKING:
+    from .downloader import Downloader
+
+
+class TorrentFileReader:
+    def __init__(self, downloader: "Downloader", offset: int, length: int) -> None:
+        self.downloader = downloader
+        self.offset = offset
+        self.length = length
+        self.position = 0
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int=os.SEEK_SET) -> int:
+        match whence:
+            case os.SEEK_SET:
+                position = offset
+            case os.SEEK_CUR:
+                position = self.position + offset
+            case os.SEEK_END:
+                position = self.length + offset
+            case _:
+                raise ValueError(f"invalid whence: {whence}")
+        if position < 0:
+            raise ValueError(f"negative seek position {position}")
+        self.position = position
+        return position
+
+    async def read(self, n: int=-1) -> bytes:
+        # Returns as soon as the piece under the cursor verifies, with whatever follows it contiguously
+        if n < 0:
+            n = self.length - self.position
+        n = min(n, self.length - self.position)
+        if n <= 0:
+            return b""
+        start = self.offset + self.position
+        end = start + n
+        pieces = self.downloader.pieces
+        piece_length = self.downloader.piece_length
+        await self.downloader.move_cursor(start)
+        index = start // piece_length
+        await self.downloader.wait_piece(index)
+        outp = bytearray()
+        while index < len(pieces) and index*piece_length < end and pieces[index].complete:
+            lo = max(start, index*piece_length) - index*piece_length
+            hi = min(end, index*piece_length + pieces[index].size) - index*piece_length
+            outp += pieces[index].data[lo:hi]
+            index += 1
+        self.position += len(outp)
+        await self.downloader.move_cursor(self.offset + self.position)
+        return bytes(outp)
+
+    async def readexactly(self, n: int) -> bytes:
+        outp = bytearray()
+        while len(outp) < n and (chunk := await self.read(n - len(outp))):
+            outp += chunk
+        return bytes(outp)
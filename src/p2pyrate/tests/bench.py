@@ -0,0 +1,17 @@
+import json
+import os
+
+
+def report(results: dict[str,float], baseline: str|os.PathLike|None=None, as_json: bool=False):
+    if as_json:
+        print(json.dumps(results))
+        return
+    base: dict[str,float] = {}
+    if baseline is not None:
+        with open(baseline) as fp:
+            base = json.load(fp)
+    for k,v in results.items():
+        if isinstance(v, (int,float)) and isinstance(b := base.get(k), (int,float)) and b:
+            print(f"{k:>24}: {v:12.6g}  (baseline {b:12.6g}, x{v/b:.3f})")
+        else:
+            print(f"{k:>24}: {v}")
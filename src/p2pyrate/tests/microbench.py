@@ -0,0 +1,165 @@
+from typing import (
+    Callable,
+)
+import argparse
+import asyncio
+import random
+import socket
+import struct
+import timeit
+
+from p2pyrate.downloader import TorrentPiece
+from p2pyrate.peer.peer import Peer, read_message, write_message
+from p2pyrate.udp_tracker import parse_announce_reponse
+from p2pyrate.utils import bl_to_bitfield, bitfield_to_bl
+from p2pyrate.tests.bench import report
+import p2pyrate.peer.message as pm
+import p2pyrate.trace as trace
+
+
+BLOCK_SIZE = 2**14
+
+
+class NullWriter:
+    def __init__(self) -> None:
+        self.written = 0
+
+    def write(self, data: bytes):
+        self.written += len(data)
+
+    async def drain(self):
+        pass
+
+
+def per_op(fn: Callable[[], object], ops: int=1) -> float:
+    number, elapsed = timeit.Timer(fn).autorange()
+    return elapsed / number / ops
+
+
+def sample_messages(n: int) -> list[pm.PeerMessage_T]:
+    block = random.Random(0).randbytes(BLOCK_SIZE)
+    outp: list[pm.PeerMessage_T] = []
+    for i in range(n):
+        match i % 4:
+            case 0:
+                outp.append(pm.Have.from_index(i))
+            case 1:
+                outp.append(pm.Request.from_block(i, 0, BLOCK_SIZE))
+            case 2:
+                outp.append(pm.Piece.from_block(i, 0, block))
+            case 3:
+                outp.append(pm.Unchoke())
+    return outp
+
+
+def bench_codec(n: int=1000) -> dict[str,float]:
+    messages = sample_messages(n)
+    writer = NullWriter()
+    encoded = b"".join(struct.pack("!IB", len(m.payload)+1, m.message_id) + m.payload for m in messages)
+    loop = asyncio.new_event_loop()
+
+    async def encode():
+        for m in messages:
+            await write_message(writer, m) # type: ignore
+
+    async def decode():
+        reader = asyncio.StreamReader()
+        reader.feed_data(encoded)
+        reader.feed_eof()
+        for _ in range(n):
+            await read_message(reader)
+
+    try:
+        return {
+            "codec_encode_us": per_op(lambda: loop.run_until_complete(encode()), n) * 1e6,
+            "codec_decode_us": per_op(lambda: loop.run_until_complete(decode()), n) * 1e6,
+        }
+    finally:
+        loop.close()
+
+
+def bench_peer(n: int=1000) -> dict[str,float]:
+    messages = sample_messages(n)
+    loop = asyncio.new_event_loop()
+
+    async def make_peer() -> Peer:
+        # The reader must be created with the loop running
+        return Peer(host="127.0.0.1", port=6881, _reader=asyncio.StreamReader(), _writer=NullWriter()) # type: ignore
+
+    async def write():
+        for m in messages:
+            await peer.write(m)
+
+    previous = trace.tracer
+    try:
+        peer = loop.run_until_complete(make_peer())
+        outp = {"peer_write_us": per_op(lambda: loop.run_until_complete(write()), n) * 1e6}
+        trace.enable()
+        outp["peer_write_traced_us"] = per_op(lambda: loop.run_until_complete(write()), n) * 1e6
+        return outp
+    finally:
+        trace.tracer = previous
+        loop.close()
+
+
+def bench_bitfield(n_pieces: int=20000) -> dict[str,float]:
+    bool_list = [random.Random(i).random() < 0.5 for i in range(n_pieces)]
+    bitfield = bl_to_bitfield(bool_list)
+    return {
+        "bl_to_bitfield_us": per_op(lambda: bl_to_bitfield(bool_list)) * 1e6,
+        "bitfield_to_bl_us": per_op(lambda: bitfield_to_bl(bitfield)) * 1e6,
+    }
+
+
+def bench_piece(piece_length: int=2**18) -> dict[str,float]:
+    block = bytes(BLOCK_SIZE)
+
+    def fill():
+        piece = TorrentPiece(index=0, hash=b"\x00"*20, size=piece_length)
+        for begin in range(0, piece_length, BLOCK_SIZE):
+            piece.missing_blocks()
+            piece.add_block(begin, block)
+            piece.complete
+
+    return {
+        "piece_fill_ms": per_op(fill) * 1e3,
+        "piece_missing_blocks_us": per_op(TorrentPiece(index=0, hash=b"\x00"*20, size=piece_length).missing_blocks) * 1e6,
+    }
+
+
+def bench_announce(n_peers: int=200) -> dict[str,float]:
+    rng = random.Random(0)
+    buf = struct.pack("!IIIII", 1, 0, 1800, n_peers, n_peers) + b"".join(
+        socket.inet_aton(f"10.0.{rng.randint(0,255)}.{rng.randint(0,255)}") + struct.pack("!H", rng.randint(1024,65535))
+        for _ in range(n_peers)
+    )
+    return {
+        "parse_announce_us": per_op(lambda: parse_announce_reponse(buf)) * 1e6,
+    }
+
+
+BENCHMARKS: dict[str,Callable[[],dict[str,float]]] = {
+    "codec": bench_codec,
+    "peer": bench_peer,
+    "bitfield": bench_bitfield,
+    "piece": bench_piece,
+    "announce": bench_announce,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks")
+    parser.add_argument("only", nargs="*", help=f"run only some of: {', '.join(BENCHMARKS)}")
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--baseline", help="JSON output of a previous run to compare against")
+    args = parser.parse_args()
+    if unknown := set(args.only) - set(BENCHMARKS):
+        parser.error(f"unknown benchmarks: {', '.join(unknown)}")
+    results: dict[str,float] = {}
+    for name in args.only or BENCHMARKS:
+        results.update(BENCHMARKS[name]())
+    report(results, baseline=args.baseline, as_json=args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,46 +1,268 @@
 from typing import (
+    BinaryIO,
     DefaultDict,
+    Iterator,
 )
 from collections import defaultdict
+from dataclasses import dataclass, field
+import socket
+import struct
 import os
 
-from scapy.all import rdpcap, TCP, Raw, IP # type: ignore
-
 from p2pyrate.peer.handshake import (
     Handshake,
     ExtendedHandshake,
 )
 
 
+BT_HEADER = b"\x13BitTorrent protocol"
+
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+
+
+@dataclass(frozen=True)
+class Flow:
+    src: str
+    sport: int
+    dst: str
+    dport: int
+
+
+@dataclass
+class TcpSegment:
+    flow: Flow
+    seq: int
+    flags: int
+    payload: bytes
+
+
+@dataclass
+class StreamChunk:
+    flow: Flow
+    time: float
+    data: bytes
+
+    @property
+    def closed(self) -> bool:
+        return not self.data
+
+
+def read_pcap(fp: BinaryIO) -> Iterator[tuple[float,int,bytes]]:
+    header = fp.read(24)
+    if len(header) < 24:
+        return
+    match header[:4]:
+        case b"\xd4\xc3\xb2\xa1":
+            endian, ts_div = "<", 1e6
+        case b"\xa1\xb2\xc3\xd4":
+            endian, ts_div = ">", 1e6
+        case b"\x4d\x3c\xb2\xa1":
+            endian, ts_div = "<", 1e9
+        case b"\xa1\xb2\x3c\x4d":
+            endian, ts_div = ">", 1e9
+        case magic:
+            raise ValueError(f"not a pcap file (magic {magic.hex()}), pcapng must be converted first")
+    linktype = struct.unpack(endian+"I", header[20:24])[0] & 0x0FFFFFFF
+    record = struct.Struct(endian+"IIII")
+    while len(buf := fp.read(16)) == 16:
+        ts_sec, ts_frac, incl_len, _ = record.unpack(buf)
+        frame = fp.read(incl_len)
+        if len(frame) < incl_len:
+            return
+        yield ts_sec + ts_frac/ts_div, linktype, frame
+
+
+def parse_tcp(linktype: int, frame: bytes) -> TcpSegment|None:
+    match linktype:
+        case 0: # BSD loopback
+            ip = frame[4:]
+        case 1: # Ethernet
+            ethertype, offset = struct.unpack("!H", frame[12:14])[0], 14
+            while ethertype in (0x8100, 0x88A8) and len(frame) >= offset+4:
+                ethertype, offset = struct.unpack("!H", frame[offset+2:offset+4])[0], offset+4
+            if ethertype not in (0x0800, 0x86DD):
+                return None
+            ip = frame[offset:]
+        case 101: # Raw IP
+            ip = frame
+        case 113: # Linux cooked capture
+            ip = frame[16:]
+        case 276: # Linux cooked capture v2
+            ip = frame[20:]
+        case _:
+            raise ValueError(f"unsupported link type: {linktype}")
+    if not ip:
+        return None
+    match ip[0] >> 4:
+        case 4:
+            ihl = (ip[0] & 0x0F) * 4
+            total_length, frag, proto = struct.unpack("!H2xHxB", ip[2:10])
+            if proto != socket.IPPROTO_TCP or frag & 0x1FFF:
+                return None
+            src, dst = socket.inet_ntop(socket.AF_INET, ip[12:16]), socket.inet_ntop(socket.AF_INET, ip[16:20])
+            tcp = ip[ihl:total_length] if total_length else ip[ihl:]
+        case 6:
+            payload_length, proto = struct.unpack("!HB", ip[4:7])
+            if proto != socket.IPPROTO_TCP:
+                return None
+            src, dst = socket.inet_ntop(socket.AF_INET6, ip[8:24]), socket.inet_ntop(socket.AF_INET6, ip[24:40])
+            tcp = ip[40:40+payload_length]
+        case _:
+            return None
+    if len(tcp) < 20:
+        return None
+    sport, dport, seq, offset_flags = struct.unpack("!HHI4xH", tcp[:14])
+    return TcpSegment(
+        flow=Flow(src, sport, dst, dport),
+        seq=seq,
+        flags=offset_flags & 0x3F,
+        payload=tcp[(offset_flags >> 12) * 4:],
+    )
+
+
+def seq_diff(a: int, b: int) -> int:
+    return ((a - b + 2**31) % 2**32) - 2**31
+
+
+@dataclass
+class _FlowState:
+    next_seq: int|None = None
+    pending: dict[int,bytes] = field(default_factory=dict)
+    pending_size: int = 0
+    # The flow closes once everything before its FIN arrived, retransmissions can still fill gaps
+    fin_seq: int|None = None
+
+
+class TcpReassembler:
+    def __init__(self, max_pending: int=16*2**20) -> None:
+        self.max_pending = max_pending
+        self.flows: dict[Flow,_FlowState] = {}
+
+    def feed(self, segment: TcpSegment) -> Iterator[bytes]:
+        state = self.flows.get(segment.flow)
+        seq = segment.seq
+        if segment.flags & TCP_SYN:
+            seq = (seq + 1) % 2**32
+            state = self.flows[segment.flow] = _FlowState(next_seq=seq)
+        elif state is None:
+            if not segment.payload:
+                return
+            # Capture started mid-stream
+            state = self.flows[segment.flow] = _FlowState(next_seq=seq)
+        if segment.payload:
+            yield from self._add(state, seq, segment.payload)
+        if segment.flags & TCP_FIN:
+            state.fin_seq = (seq + len(segment.payload)) % 2**32
+        if segment.flags & TCP_RST:
+            # Nothing is retransmitted after a reset
+            yield from self._flush(state)
+        if segment.flags & TCP_RST or state.next_seq == state.fin_seq:
+            del self.flows[segment.flow]
+            yield b""
+
+    def close(self) -> Iterator[tuple[Flow,bytes]]:
+        # End of the capture, deliver what arrived past the gaps of the flows still open
+        for flow, state in self.flows.items():
+            for data in self._flush(state):
+                yield flow, data
+            yield flow, b""
+        self.flows.clear()
+
+    def _add(self, state: _FlowState, seq: int, payload: bytes) -> Iterator[bytes]:
+        assert state.next_seq is not None
+        offset = seq_diff(seq, state.next_seq)
+        if offset + len(payload) <= 0:
+            return
+        if offset > 0:
+            if len(state.pending.get(seq, b"")) < len(payload):
+                state.pending_size += len(payload) - len(state.pending.get(seq, b""))
+                state.pending[seq] = payload
+            if state.pending_size > self.max_pending:
+                # Segments were lost by the capture, skip the gap
+                yield from self._skip_gap(state)
+            return
+        yield payload[-offset:]
+        state.next_seq = (state.next_seq + len(payload) + offset) % 2**32
+        yield from self._drain(state)
+
+    def _skip_gap(self, state: _FlowState) -> Iterator[bytes]:
+        state.next_seq = min(state.pending, key=lambda s: seq_diff(s, state.next_seq)) # type: ignore
+        yield from self._drain(state)
+
+    def _flush(self, state: _FlowState) -> Iterator[bytes]:
+        while state.pending:
+            yield from self._skip_gap(state)
+
+    def _drain(self, state: _FlowState) -> Iterator[bytes]:
+        assert state.next_seq is not None
+        while state.pending:
+            seq = min(state.pending, key=lambda s: seq_diff(s, state.next_seq)) # type: ignore
+            if (offset := seq_diff(seq, state.next_seq)) > 0:
+                return
+            payload = state.pending.pop(seq)
+            state.pending_size -= len(payload)
+            if offset + len(payload) > 0:
+                yield payload[-offset:]
+                state.next_seq = (state.next_seq + len(payload) + offset) % 2**32
+
+
+def iter_tcp_streams(pcap: str|os.PathLike, max_pending: int=16*2**20) -> Iterator[StreamChunk]:
+    reassembler = TcpReassembler(max_pending=max_pending)
+    ts = 0.0
+    with open(pcap, "rb") as fp:
+        for ts, linktype, frame in read_pcap(fp):
+            if (segment := parse_tcp(linktype, frame)) is None:
+                continue
+            for data in reassembler.feed(segment):
+                yield StreamChunk(segment.flow, ts, data)
+    for flow, data in reassembler.close():
+        yield StreamChunk(flow, ts, data)
+
+
+def iter_bt_streams(pcap: str|os.PathLike, max_pending: int=16*2**20) -> Iterator[StreamChunk]:
+    bt_flows: dict[Flow,bool] = {}
+    for chunk in iter_tcp_streams(pcap, max_pending=max_pending):
+        if (is_bt := bt_flows.get(chunk.flow)) is None:
+            if chunk.closed:
+                continue
+            # Both directions of a connection start with the handshake
+            is_bt = bt_flows[chunk.flow] = chunk.data.startswith(BT_HEADER[:len(chunk.data)])
+        if is_bt:
+            yield chunk
+        if chunk.closed:
+            del bt_flows[chunk.flow]
+
+
 def extract_bt_handshakes(pcap: str|os.PathLike) -> dict[tuple[str,str],tuple[Handshake,ExtendedHandshake|None]]:
-    packets = rdpcap(pcap)
-    handshakes: dict[tuple[str,str],bytes] = {}
-    # Filter normal handshakes
-    for pkt in packets:
-        if pkt.haslayer(TCP) and b'\x13BitTorrent protocol' in bytes(pkt[TCP].payload):
-            handshakes[(pkt[IP].src,pkt[IP].dst)] = pkt[Raw].load
-    # Filter extended handshakes
-    ext_handshakes: dict[tuple[str,str],bytes] = {}
-    for pkt in packets:
-        if pkt.haslayer(TCP) and pkt.haslayer(Raw):
-            raw = pkt[Raw].load
-            if len(raw)>5 and raw[4]==20:
-                ext_handshakes[(pkt[IP].src,pkt[IP].dst)] = raw
-    # Link normal and extended handshakes
+    heads: DefaultDict[Flow,bytearray] = defaultdict(bytearray)
+    done: set[Flow] = set()
     outp: dict[tuple[str,str],tuple[Handshake,ExtendedHandshake|None]] = {}
-    for session, raw in handshakes.items():
-        if (hs := Handshake.from_bytes(raw)).extended_support:
-            if (e_raw := ext_handshakes.get(session)) is not None:
-                outp[session] = (hs, ExtendedHandshake.from_bytes(e_raw))
-            else:
-                outp[session] = (hs,None)
+    for chunk in iter_bt_streams(pcap):
+        if chunk.flow in done:
+            continue
+        head = heads[chunk.flow]
+        head += chunk.data
+        # Wait for the handshake and the message following it
+        need = 72 if len(head) < 72 else 72 + struct.unpack("!I", head[68:72])[0]
+        if len(head) < need and not chunk.closed:
+            continue
+        done.add(chunk.flow)
+        del heads[chunk.flow]
+        if len(head) < 68 or not (hs := Handshake.from_bytes(bytes(head))).extended_support:
+            continue
+        # The extended handshake is the first message after the handshake when supported
+        ext = ExtendedHandshake.from_bytes(bytes(head[68:need]))
+        if ext is not None and (len(head) < need or ext.message_id != 20 or ext.extended_message_id != 0):
+            ext = None
+        outp[(chunk.flow.src,chunk.flow.dst)] = (hs, ext)
     return outp
 
 
 def extract_bt_sessions(pcap: str|os.PathLike) -> list[list[tuple[bytes,float]]]:
-    packets = rdpcap(str(pcap))
     sessions: DefaultDict[tuple[str,str],list[tuple[bytes,float]]] = defaultdict(list)
-    for pkt in packets:
-        if pkt.haslayer(TCP) and pkt.haslayer(Raw):
-            sessions[(pkt[IP].src,pkt[IP].dst)].append((pkt[Raw].load,pkt.time))
-    return [sorted(s, key=lambda x: x[1]) for s in sessions.values() if any(b"\x13BitTorrent protocol" in m for m,_ in s)]
+    for chunk in iter_bt_streams(pcap):
+        if not chunk.closed:
+            sessions[(chunk.flow.src,chunk.flow.dst)].append((chunk.data,chunk.time))
+    return list(sessions.values())
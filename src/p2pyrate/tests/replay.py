@@ -0,0 +1,153 @@
+from typing import (
+    Hashable,
+    Iterable,
+    Iterator,
+)
+from collections import Counter
+from dataclasses import dataclass, field
+from pathlib import Path
+import argparse
+import asyncio
+import os
+import struct
+import time
+
+from p2pyrate.peer.handshake import Handshake
+from p2pyrate.peer.peer import read_message
+from p2pyrate.tests.pcap import Flow, iter_bt_streams
+from p2pyrate.tests.bench import report
+
+
+@dataclass
+class ReplayStats:
+    streams: int = 0
+    bytes: int = 0
+    handshakes: int = 0
+    messages: Counter[int] = field(default_factory=Counter)
+    unparsed: int = 0
+    elapsed: float = 0.0
+
+    def summary(self) -> dict:
+        return {
+            "streams": self.streams,
+            "bytes": self.bytes,
+            "handshakes": self.handshakes,
+            "messages": self.messages.total(),
+            "unparsed": self.unparsed,
+            "mb_per_s": self.bytes / self.elapsed / 1e6,
+            "messages_per_s": self.messages.total() / self.elapsed,
+            **{f"message_{k}": v for k,v in sorted(self.messages.items())},
+        }
+
+
+def corpus_name(flow: Flow) -> str:
+    return f"{flow.src}_{flow.sport}-{flow.dst}_{flow.dport}.bt".replace(":", ".")
+
+
+def save_corpus(pcap: str|os.PathLike, directory: str|os.PathLike, flush_size: int=2**20) -> int:
+    directory = Path(directory)
+    directory.mkdir(parents=True, exist_ok=True)
+    buffers: dict[Flow,bytearray] = {}
+
+    def flush(flow: Flow, data: bytearray):
+        with open(directory / corpus_name(flow), "ab") as fp:
+            fp.write(data)
+        data.clear()
+
+    for chunk in iter_bt_streams(pcap):
+        data = buffers.setdefault(chunk.flow, bytearray())
+        data += chunk.data
+        if chunk.closed:
+            flush(chunk.flow, buffers.pop(chunk.flow))
+        elif len(data) > flush_size:
+            flush(chunk.flow, data)
+    for flow, data in buffers.items():
+        flush(flow, data)
+    return len(list(directory.glob("*.bt")))
+
+
+def load_corpus(source: str|os.PathLike, read_size: int=2**20) -> Iterator[tuple[Hashable,bytes]]:
+    # Yields (stream, chunk) as the data comes, an empty chunk ends its stream
+    source = Path(source)
+    if source.is_dir():
+        for path in sorted(source.glob("*.bt")):
+            with open(path, "rb") as fp:
+                while chunk := fp.read(read_size):
+                    yield path, chunk
+            yield path, b""
+        return
+    for chunk in iter_bt_streams(source):
+        yield chunk.flow, chunk.data
+
+
+async def parse_stream(reader: asyncio.StreamReader, stats: ReplayStats):
+    try:
+        await Handshake.from_reader(reader)
+    except asyncio.IncompleteReadError:
+        return
+    stats.handshakes += 1
+    while True:
+        try:
+            message = await read_message(reader)
+        except asyncio.IncompleteReadError:
+            return
+        except (ValueError, struct.error):
+            # Keep-alives and messages the client does not speak yet, the frame was consumed
+            stats.unparsed += 1
+            continue
+        stats.messages[message.message_id] += 1
+
+
+async def replay(chunks: Iterable[tuple[Hashable,bytes]], chunk_size: int=1460) -> ReplayStats:
+    stats = ReplayStats()
+    start = time.perf_counter()
+    # Every stream is parsed while it is read, only what its parser has not consumed yet is buffered
+    streams: dict[Hashable,tuple[asyncio.StreamReader,asyncio.Task]] = {}
+    for key, data in chunks:
+        if (stream := streams.get(key)) is None:
+            if not data:
+                continue
+            reader = asyncio.StreamReader(limit=2**32)
+            stream = streams[key] = reader, asyncio.create_task(parse_stream(reader, stats))
+            stats.streams += 1
+        reader, task = stream
+        if not data:
+            reader.feed_eof()
+            await streams.pop(key)[1]
+            continue
+        stats.bytes += len(data)
+        if task.done():
+            # The parser gave up on this stream
+            continue
+        view = memoryview(data)
+        for i in range(0, len(data), chunk_size):
+            reader.feed_data(view[i:i+chunk_size])
+            await asyncio.sleep(0)
+    for reader, _ in streams.values():
+        reader.feed_eof()
+    await asyncio.gather(*(task for _,task in streams.values()))
+    stats.elapsed = time.perf_counter() - start
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay captured BitTorrent streams through the message parsers")
+    parser.add_argument("source", help="pcap file or corpus directory")
+    parser.add_argument("--save-corpus", metavar="DIR", help="write the reassembled streams of the pcap to DIR and exit")
+    parser.add_argument("--chunk-size", type=int, default=1460, help="bytes fed to the reader between parser steps")
+    parser.add_argument("--preload", action="store_true", help="reassemble everything before timing the parsers")
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--baseline", help="JSON output of a previous run to compare against")
+    args = parser.parse_args()
+    if args.save_corpus:
+        print(f"saved {save_corpus(args.source, args.save_corpus)} streams to {args.save_corpus}")
+        return
+    chunks: Iterable[tuple[Hashable,bytes]] = load_corpus(args.source)
+    if args.preload:
+        chunks = list(chunks)
+    stats = asyncio.run(replay(chunks, chunk_size=args.chunk_size))
+    report(stats.summary(), baseline=args.baseline, as_json=args.json)
+
+
+if __name__ == "__main__":
+    main()
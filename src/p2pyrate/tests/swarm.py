@@ -0,0 +1,362 @@
+from typing import (
+    Self,
+)
+from dataclasses import dataclass, asdict, field
+from hashlib import sha1
+import argparse
+import asyncio
+import multiprocessing as mp
+import random
+import resource
+import socket
+import sys
+import time
+
+from loguru import logger as log
+
+from p2pyrate.metadata import Metadata
+from p2pyrate.downloader import Downloader, Event, CompletePiece
+from p2pyrate.utp import UtpSocket
+from p2pyrate.workers import Coordinator
+import p2pyrate.peer.message as pm
+from p2pyrate.tests.bench import report
+
+
+@dataclass
+class SwarmSpec:
+    size: int = 4*2**20
+    piece_length: int = 2**16
+    files: int = 1
+    seeders: int = 1
+    leechers: int = 1
+    processes: int = 1
+    workers: int = 0
+    seed: int = 0
+    # Streaming leechers seek to this many random offsets of the first file while downloading
+    seeks: int = 0
+    read_ahead: int = 8
+    utp: bool = False
+    # Simulated link of the uTP sockets, loss probability and one way delay in seconds
+    loss: float = 0.0
+    delay: float = 0.0
+
+
+def make_synthetic_torrent(size: int, piece_length: int, files: int=1, seed: int=0) -> tuple[Metadata,bytes]:
+    data = random.Random(seed).randbytes(size)
+    pieces = b"".join(sha1(data[i:i+piece_length]).digest() for i in range(0, size, piece_length))
+    info: dict = {
+        b"name": b"synthetic",
+        b"piece length": piece_length,
+        b"pieces": pieces,
+    }
+    if files == 1:
+        info[b"length"] = size
+    else:
+        lengths = [size//files] * files
+        lengths[-1] += size - sum(lengths)
+        info[b"files"] = [{b"length": length, b"path": [f"{i:04}.bin".encode()]} for i,length in enumerate(lengths)]
+    metadata = Metadata({
+        b"announce": b"udp://127.0.0.1:6969/announce",
+        b"announce-list": [[b"udp://127.0.0.1:6969/announce"]],
+        b"info": info,
+    })
+    return metadata, data
+
+
+class MeteredQueue(asyncio.Queue):
+    def __init__(self) -> None:
+        super().__init__()
+        self.received: int = 0
+        self.first_piece: float|None = None
+
+    async def get(self) -> Event:
+        e = await super().get()
+        match e.message:
+            case pm.Piece() as m:
+                self.received += len(m.payload) - 8
+            case CompletePiece() if self.first_piece is None:
+                self.first_piece = time.perf_counter()
+        return e
+
+
+class MeteredCoordinator(Coordinator):
+    first_piece: float|None = None
+
+    def on_ipc(self, w: int, buf: bytes):
+        super().on_ipc(w, buf)
+        if self.first_piece is None and self.picker.have:
+            self.first_piece = time.perf_counter()
+
+
+@dataclass
+class LeecherStats:
+    elapsed: float
+    # Bytes received are only seen by the workers in multi-process mode
+    received: int|None
+    first_piece: float
+    # Time until the first byte at a new offset is readable
+    seek_latencies: list[float] = field(default_factory=list)
+
+
+@dataclass
+class SwarmResult:
+    spec: SwarmSpec
+    elapsed: float
+    cpu_seconds: float
+    peak_rss: int
+    leechers: list[LeecherStats] = field(default_factory=list)
+
+    @property
+    def downloaded(self) -> int:
+        return self.spec.size * len(self.leechers)
+
+    @property
+    def mb_per_s(self) -> float:
+        return self.downloaded / self.elapsed / 1e6
+
+    @property
+    def cpu_s_per_gb(self) -> float:
+        return self.cpu_seconds / (self.downloaded / 1e9)
+
+    @property
+    def duplicate_ratio(self) -> float:
+        if any(s.received is None for s in self.leechers):
+            return float("nan")
+        return sum(s.received or 0 for s in self.leechers) / self.downloaded - 1
+
+    @property
+    def time_to_first_piece(self) -> float:
+        return max(s.first_piece for s in self.leechers)
+
+    @property
+    def seek_latencies(self) -> list[float]:
+        return [t for s in self.leechers for t in s.seek_latencies]
+
+    def summary(self) -> dict:
+        seeks = self.seek_latencies
+        return {
+            "spec": asdict(self.spec),
+            "mb_per_s": self.mb_per_s,
+            "cpu_s_per_gb": self.cpu_s_per_gb,
+            "peak_rss_mb": self.peak_rss / 2**20,
+            "duplicate_ratio": self.duplicate_ratio,
+            "time_to_first_piece": self.time_to_first_piece,
+            "seek_latency_mean": sum(seeks) / len(seeks) if seeks else float("nan"),
+            "seek_latency_max": max(seeks, default=float("nan")),
+            "elapsed": self.elapsed,
+        }
+
+    @classmethod
+    def merge(cls, spec: SwarmSpec, parts: list[tuple[list[LeecherStats],float,int]]) -> Self:
+        leechers = [s for stats,_,_ in parts for s in stats]
+        return cls(
+            spec=spec,
+            elapsed=max(s.elapsed for s in leechers),
+            cpu_seconds=sum(cpu for _,cpu,_ in parts),
+            peak_rss=max(rss for _,_,rss in parts),
+            leechers=leechers,
+        )
+
+
+def free_ports(n: int) -> list[int]:
+    socks = [socket.socket() for _ in range(n)]
+    for s in socks:
+        s.bind(("127.0.0.1", 0))
+    ports = [s.getsockname()[1] for s in socks]
+    for s in socks:
+        s.close()
+    return ports
+
+
+def cpu_seconds() -> float:
+    # Worker processes are accounted for once they have been joined
+    return sum(ru.ru_utime + ru.ru_stime for ru in map(resource.getrusage, (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)))
+
+
+def peak_rss() -> int:
+    # ru_maxrss is in kilobytes on Linux
+    return max(resource.getrusage(r).ru_maxrss for r in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)) * 1024
+
+
+def setup_logging(level: str):
+    log.remove()
+    log.add(sys.stderr, level=level)
+
+
+def make_seeder(metadata: Metadata, data: bytes, workers: int=0, log_level: str="WARNING") -> Downloader|Coordinator:
+    if workers:
+        c = Coordinator(metadata, workers=workers, log_level=log_level)
+        for index in range(len(c.hashes)):
+            start = index * c.piece_length
+            c.set_complete_data(index, data[start:start+c.piece_length])
+        return c
+    d = Downloader(metadata)
+    for p in d.pieces:
+        start = p.index * d.piece_length
+        p.set_complete_data(data[start:start+p.size])
+    return d
+
+
+async def connect(d: Downloader, host: str, port: int, retries: int=100, utp: bool=False):
+    for _ in range(retries):
+        try:
+            return await d.add_peer(host, port, utp=utp)
+        except ConnectionRefusedError:
+            await asyncio.sleep(0.05)
+    raise ConnectionRefusedError(f"{host}:{port}")
+
+
+async def run_coordinated_leecher(metadata: Metadata, seeders: list[int], workers: int, log_level: str) -> LeecherStats:
+    c = MeteredCoordinator(metadata, workers=workers, log_level=log_level)
+    await c.start_workers()
+    try:
+        start = time.perf_counter()
+        # One connection per worker and seeder so every worker has a share of the traffic
+        for port in seeders:
+            for _ in range(workers):
+                await c.add_peer("127.0.0.1", port)
+        await c.handle_events()
+        elapsed = time.perf_counter() - start
+    finally:
+        c.close()
+    assert c.first_piece is not None
+    return LeecherStats(elapsed=elapsed, received=None, first_piece=c.first_piece-start)
+
+
+async def seek_randomly(d: Downloader, seeks: int, read_ahead: int, seed: int, latencies: list[float]):
+    reader = d.open(0, read_ahead=read_ahead)
+    rng = random.Random(seed)
+    for _ in range(seeks):
+        reader.seek(rng.randrange(reader.length))
+        start = time.perf_counter()
+        await reader.read(1)
+        latencies.append(time.perf_counter() - start)
+
+
+async def run_leecher(metadata: Metadata, seeders: list[int], spec: SwarmSpec, log_level: str="WARNING", seed: int=0) -> LeecherStats:
+    if spec.workers:
+        return await run_coordinated_leecher(metadata, seeders, spec.workers, log_level)
+    d = Downloader(metadata)
+    d.event_q = q = MeteredQueue()
+    if spec.utp:
+        d.use_utp(await UtpSocket.bind(loss=spec.loss, delay=spec.delay))
+    latencies: list[float] = []
+    start = time.perf_counter()
+    tasks = [asyncio.create_task(connect(d, "127.0.0.1", port, utp=spec.utp)) for port in seeders]
+    if spec.seeks:
+        tasks.append(asyncio.create_task(seek_randomly(d, spec.seeks, spec.read_ahead, seed, latencies)))
+    await d.handle_events()
+    elapsed = time.perf_counter() - start
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    if d.utp is not None:
+        d.utp.close()
+    assert q.first_piece is not None
+    return LeecherStats(elapsed=elapsed, received=q.received, first_piece=q.first_piece-start, seek_latencies=latencies)
+
+
+async def run_node(spec: SwarmSpec, seed_ports: list[int], all_ports: list[int], leechers: int, stop, log_level: str) -> tuple[list[LeecherStats],float,int]:
+    metadata, data = make_synthetic_torrent(spec.size, spec.piece_length, spec.files, spec.seed)
+    seeders = [make_seeder(metadata, data, spec.workers, log_level) for _ in seed_ports]
+    del data
+    for s,port in zip(seeders, seed_ports):
+        if spec.utp and isinstance(s, Downloader):
+            s.use_utp(await UtpSocket.bind(port=port, loss=spec.loss, delay=spec.delay))
+    tasks = [asyncio.create_task(s.start(port)) for s,port in zip(seeders, seed_ports)]
+    # Torrent generation and hashing are not part of the measurement
+    cpu = cpu_seconds()
+    stats = await asyncio.gather(*(
+        run_leecher(metadata, all_ports, spec, log_level, spec.seed+i)
+        for i in range(leechers)
+    ))
+    await stop()
+    for t in tasks:
+        t.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for s in seeders:
+        if isinstance(s, Coordinator):
+            s.close()
+        elif s.utp is not None:
+            s.utp.close()
+    return stats, cpu_seconds()-cpu, peak_rss()
+
+
+def _node_process(spec: SwarmSpec, seed_ports: list[int], all_ports: list[int], leechers: int, results, stop_event, log_level: str):
+    setup_logging(log_level)
+    async def stop():
+        results.put("done")
+        await asyncio.get_running_loop().run_in_executor(None, stop_event.wait)
+    results.put(asyncio.run(run_node(spec, seed_ports, all_ports, leechers, stop, log_level)))
+
+
+def run_swarm(spec: SwarmSpec, log_level: str="WARNING") -> SwarmResult:
+    ports = free_ports(spec.seeders)
+    nodes = max(1, min(spec.processes, spec.seeders+spec.leechers))
+    seed_ports: list[list[int]] = [ports[i::nodes] for i in range(nodes)]
+    leechers: list[int] = [len(range(spec.leechers)[i::nodes]) for i in range(nodes)]
+    if nodes == 1:
+        async def stop():
+            pass
+        return SwarmResult.merge(spec, [asyncio.run(run_node(spec, ports, ports, spec.leechers, stop, log_level))])
+    ctx = mp.get_context("spawn")
+    results = ctx.Queue()
+    stop_event = ctx.Event()
+    procs = [
+        ctx.Process(target=_node_process, args=(spec, seed_ports[i], ports, leechers[i], results, stop_event, log_level))
+        for i in range(nodes)
+    ]
+    for p in procs:
+        p.start()
+    # Seeders keep serving other nodes until every node is done leeching
+    for _ in range(nodes):
+        assert results.get() == "done"
+    stop_event.set()
+    parts = [results.get() for _ in range(nodes)]
+    for p in procs:
+        p.join()
+    return SwarmResult.merge(spec, parts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback swarm benchmark")
+    parser.add_argument("--size", type=int, default=SwarmSpec.size)
+    parser.add_argument("--piece-length", type=int, default=SwarmSpec.piece_length)
+    parser.add_argument("--files", type=int, default=SwarmSpec.files)
+    parser.add_argument("--seeders", type=int, default=SwarmSpec.seeders)
+    parser.add_argument("--leechers", type=int, default=SwarmSpec.leechers)
+    parser.add_argument("--processes", type=int, default=SwarmSpec.processes)
+    parser.add_argument("--workers", type=int, default=SwarmSpec.workers, help="run every seeder and leecher in multi-process mode")
+    parser.add_argument("--seed", type=int, default=SwarmSpec.seed)
+    parser.add_argument("--seeks", type=int, default=SwarmSpec.seeks, help="measure seek latency in streaming mode")
+    parser.add_argument("--read-ahead", type=int, default=SwarmSpec.read_ahead, help="streaming window in pieces")
+    parser.add_argument("--utp", action="store_true", help="connect over uTP instead of TCP")
+    parser.add_argument("--loss", type=float, default=SwarmSpec.loss, help="simulated uTP packet loss probability")
+    parser.add_argument("--delay", type=float, default=SwarmSpec.delay, help="simulated uTP one way delay in seconds")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", action="store_true")
+    parser.add_argument("--baseline", help="JSON output of a previous run to compare against")
+    args = parser.parse_args()
+    if args.utp and args.workers:
+        parser.error("--utp is not supported in multi-process mode")
+    setup_logging(args.log_level)
+    spec = SwarmSpec(
+        size=args.size,
+        piece_length=args.piece_length,
+        files=args.files,
+        seeders=args.seeders,
+        leechers=args.leechers,
+        processes=args.processes,
+        workers=args.workers,
+        seed=args.seed,
+        seeks=args.seeks,
+        read_ahead=args.read_ahead,
+        utp=args.utp,
+        loss=args.loss,
+        delay=args.delay,
+    )
+    report(run_swarm(spec, args.log_level).summary(), baseline=args.baseline, as_json=args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+from typing import (
+    Iterator,
+    Self,
+)
+from dataclasses import dataclass
+import argparse
+import atexit
+import multiprocessing
+import os
+import signal
+import struct
+import time
+
+import bencode2
+
+
+READ = 0
+WRITE = 1
+
+MAGIC = b"P2PTRACE"
+HEADER = struct.Struct("<8sIII")
+# timestamp (ns), peer index, direction, message id, payload length
+RECORD = struct.Struct("<QIBBxxI")
+
+
+@dataclass
+class TraceRecord:
+    timestamp: int
+    peer: str
+    direction: int
+    message_id: int
+    length: int
+
+    def __str__(self) -> str:
+        arrow = "<-" if self.direction == READ else "->"
+        return f"{self.timestamp/1e9:.6f} {arrow} {self.peer} {self.message_id} {self.length}"
+
+
+class Tracer:
+    def __init__(self, capacity: int=2**16) -> None:
+        self.capacity = capacity
+        self.buffer = bytearray(capacity * RECORD.size)
+        self.count = 0
+        self.peers: dict[tuple[str,int],int] = {}
+
+    def record(self, direction: int, peer: tuple[str,int], message_id: int, length: int):
+        if (index := self.peers.get(peer)) is None:
+            index = self.peers[peer] = len(self.peers)
+        RECORD.pack_into(self.buffer, (self.count % self.capacity) * RECORD.size, time.time_ns(), index, direction, message_id, length)
+        self.count += 1
+
+    def ordered(self) -> bytes:
+        if self.count <= self.capacity:
+            return bytes(self.buffer[:self.count*RECORD.size])
+        split = (self.count % self.capacity) * RECORD.size
+        return bytes(self.buffer[split:] + self.buffer[:split])
+
+    def dump(self, path: str|os.PathLike):
+        table = bencode2.bencode([f"{host}:{port}".encode() for host,port in self.peers])
+        records = self.ordered()
+        with open(path, "wb") as fp:
+            fp.write(HEADER.pack(MAGIC, RECORD.size, len(records)//RECORD.size, len(table)))
+            fp.write(table)
+            fp.write(records)
+
+
+tracer: Tracer|None = None
+
+
+def enable(capacity: int=2**16, dump_path: str|os.PathLike|None=None) -> Tracer:
+    global tracer
+    tracer = Tracer(capacity)
+    if dump_path is not None:
+        # Dump on exit, including exits caused by an unhandled exception, and on SIGUSR1
+        atexit.register(lambda: dump(process_path(dump_path)))
+        if hasattr(signal, "SIGUSR1"):
+            signal.signal(signal.SIGUSR1, lambda *_: dump(process_path(dump_path)))
+    return tracer
+
+
+def disable():
+    global tracer
+    tracer = None
+
+
+def process_path(path: str|os.PathLike) -> str:
+    # Worker processes import this module again, each one gets its own dump next to the main one
+    if multiprocessing.parent_process() is None:
+        return os.fspath(path)
+    return f"{os.fspath(path)}.{os.getpid()}"
+
+
+def dump(path: str|os.PathLike):
+    if tracer is not None:
+        tracer.dump(path)
+
+
+@dataclass
+class Trace:
+    peers: list[str]
+    records: bytes
+
+    def __iter__(self) -> Iterator[TraceRecord]:
+        for timestamp, peer, direction, message_id, length in RECORD.iter_unpack(self.records):
+            yield TraceRecord(timestamp, self.peers[peer], direction, message_id, length)
+
+    def __len__(self) -> int:
+        return len(self.records) // RECORD.size
+
+    @classmethod
+    def from_file(cls, path: str|os.PathLike) -> Self:
+        with open(path, "rb") as fp:
+            magic, record_size, count, table_len = HEADER.unpack(fp.read(HEADER.size))
+            if magic != MAGIC or record_size != RECORD.size:
+                raise ValueError(f"not a trace file: {path}")
+            peers = [p.decode() for p in bencode2.bdecode(fp.read(table_len))]
+            records = fp.read(count*record_size)
+        return cls(peers=peers, records=records)
+
+
+if (_path := os.environ.get("P2PYRATE_TRACE")):
+    enable(int(os.environ.get("P2PYRATE_TRACE_CAPACITY", 2**16)), dump_path=_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decode a wire trace")
+    parser.add_argument("path")
+    args = parser.parse_args()
+    for r in Trace.from_file(args.path):
+        print(r)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,7 @@
+from hashlib import sha1
+import ipaddress
+
+
 
 def bl_to_bitfield(bool_list: list[bool]) -> bytes:
     lcopy = bool_list.copy()
@@ -11,4 +15,22 @@ def bitfield_to_bl(bitfield: bytes) -> list[bool]:
         for i in range(8):
             offset = 7-i
             outp.append(b & (1 << offset) >0)
-    return outp
\ No newline at end of file
+    return outp
+
+
+def allowed_fast_set(ip: str, info_hash: bytes, n_pieces: int, k: int=10) -> list[int]:
+    # Canonical allowed fast set of BEP 6, IPv6 addresses are masked to their /48 like IPv4 ones to their /24
+    addr = ipaddress.ip_address(ip)
+    if addr.version == 4:
+        x = (int(addr) & 0xFFFFFF00).to_bytes(4) + info_hash
+    else:
+        x = (int(addr) >> 80 << 80).to_bytes(16) + info_hash
+    outp: list[int] = []
+    k = min(k, n_pieces)
+    while len(outp) < k:
+        x = sha1(x).digest()
+        for i in range(0, 20, 4):
+            index = int.from_bytes(x[i:i+4]) % n_pieces
+            if index not in outp and len(outp) < k:
+                outp.append(index)
+    return outp
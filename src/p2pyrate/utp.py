@@ -0,0 +1,580 @@
+from typing import (
+    Callable,
+    Self,
+)
+from collections import deque
+from dataclasses import dataclass
+from enum import IntEnum
+import asyncio
+import random
+import socket
+import struct
+import time
+
+from loguru import logger as log
+
+
+class PacketType(IntEnum):
+    DATA = 0
+    FIN = 1
+    STATE = 2
+    RESET = 3
+    SYN = 4
+
+
+VERSION = 1
+
+HEADER = struct.Struct("!BBHIIIHH")
+EXT_SELECTIVE_ACK = 1
+
+# Payload bytes per packet, small enough for a 1500 bytes MTU once the UDP and IP headers are added
+PACKET_SIZE = 1400
+RECV_WINDOW = 2**20
+SOCKET_BUFFER = 4 * 2**20
+# LEDBAT
+CCONTROL_TARGET = 100_000
+MAX_CWND_INCREASE_BYTES_PER_RTT = 3000
+MIN_WINDOW = 2 * PACKET_SIZE
+BASE_DELAY_HISTORY = 2
+MIN_TIMEOUT = 0.5
+MAX_RETRIES = 8
+
+
+def now_us() -> int:
+    return time.monotonic_ns() // 1000 & 0xFFFFFFFF
+
+
+def seq_diff(a: int, b: int) -> int:
+    # Signed distance from b to a in the 16 bits sequence space
+    d = (a - b) & 0xFFFF
+    return d - 0x10000 if d >= 0x8000 else d
+
+
+@dataclass
+class Packet:
+    type: PacketType
+    connection_id: int
+    seq_nr: int
+    ack_nr: int
+    wnd_size: int = 0
+    timestamp: int = 0
+    timestamp_difference: int = 0
+    sack: bytes|None = None
+    payload: bytes = b""
+
+    def to_bytes(self) -> bytes:
+        extension = EXT_SELECTIVE_ACK if self.sack else 0
+        buf = HEADER.pack(
+            self.type << 4 | VERSION,
+            extension,
+            self.connection_id,
+            self.timestamp,
+            self.timestamp_difference,
+            self.wnd_size,
+            self.seq_nr,
+            self.ack_nr,
+        )
+        if self.sack:
+            buf += struct.pack("!BB", 0, len(self.sack)) + self.sack
+        return buf + self.payload
+
+    @classmethod
+    def from_bytes(cls, buf: bytes) -> Self:
+        if len(buf) < HEADER.size:
+            raise ValueError(f"uTP packet too short {len(buf)}<{HEADER.size}")
+        type_ver, extension, connection_id, timestamp, timestamp_difference, wnd_size, seq_nr, ack_nr = HEADER.unpack_from(buf)
+        if type_ver & 0xF != VERSION or type_ver >> 4 > PacketType.SYN:
+            raise ValueError(f"not a uTP packet {type_ver:#x}")
+        offset = HEADER.size
+        sack = None
+        while extension:
+            if len(buf) < offset + 2:
+                raise ValueError("truncated uTP extension")
+            next_extension, length = buf[offset], buf[offset+1]
+            if extension == EXT_SELECTIVE_ACK:
+                sack = buf[offset+2:offset+2+length]
+            extension = next_extension
+            offset += 2 + length
+        return cls(
+            type=PacketType(type_ver >> 4),
+            connection_id=connection_id,
+            seq_nr=seq_nr,
+            ack_nr=ack_nr,
+            wnd_size=wnd_size,
+            timestamp=timestamp,
+            timestamp_difference=timestamp_difference,
+            sack=sack,
+            payload=buf[offset:],
+        )
+
+
+@dataclass
+class OutPacket:
+    packet: Packet
+    sent_at: float = 0.0
+    transmissions: int = 0
+    # Presumed lost, not counted in the window until sent again
+    need_resend: bool = False
+
+
+class UtpConnection(asyncio.Transport):
+    def __init__(self, sock: "UtpSocket", addr: tuple[str,int], recv_id: int, send_id: int, protocol: asyncio.Protocol) -> None:
+        super().__init__()
+        self.socket = sock
+        self.addr = addr
+        self.recv_id = recv_id
+        self.send_id = send_id
+        self.protocol = protocol
+        self.loop = asyncio.get_running_loop()
+        self.seq_nr: int = 1
+        self.ack_nr: int = 0
+        self.connected: asyncio.Future[None] = self.loop.create_future()
+        self.closing: bool = False
+        self.closed: bool = False
+        self.lost: bool = False
+        # Sender
+        self.send_buffer = bytearray()
+        self.flush_scheduled: bool = False
+        self.in_flight: dict[int,OutPacket] = {}
+        self.cur_window: int = 0
+        self.resends: int = 0
+        self.max_window: float = MIN_WINDOW
+        self.slow_start: bool = True
+        self.peer_wnd: int = RECV_WINDOW
+        self.high_water: int = 4 * RECV_WINDOW
+        self.low_water: int = RECV_WINDOW
+        self.writing_paused: bool = False
+        self.fin_seq: int|None = None
+        self.last_ack: int|None = None
+        self.dup_acks: int = 0
+        self.fast_resend_seq: int|None = None
+        self.rtt: float|None = None
+        self.rtt_var: float = 0.0
+        self.timeout: float = 1.0
+        self.retries: int = 0
+        self.timer: asyncio.TimerHandle|None = None
+        # Minimum delay of each of the last minutes
+        self.base_delays: deque[tuple[int,int]] = deque()
+        # Receiver
+        self.reorder: dict[int,Packet] = {}
+        self.reply_micro: int = 0
+        self.eof_seq: int|None = None
+        self.reading_paused: bool = False
+        self.ack_scheduled: bool = False
+
+    def __repr__(self) -> str:
+        return f"UtpConnection({self.addr[0]}:{self.addr[1]}, {self.recv_id})"
+
+    # Transport interface
+
+    def get_extra_info(self, name, default=None):
+        match name:
+            case "peername":
+                return self.addr
+            case "sockname":
+                return self.socket.sockname
+            case _:
+                return default
+
+    def is_closing(self) -> bool:
+        return self.closing or self.closed
+
+    def write(self, data):
+        if self.is_closing():
+            return
+        self.send_buffer += data
+        # Small writes issued in one loop iteration share packets
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self.flush)
+        if not self.writing_paused and len(self.send_buffer) > self.high_water:
+            self.writing_paused = True
+            self.protocol.pause_writing()
+
+    def can_write_eof(self) -> bool:
+        return False
+
+    def get_write_buffer_size(self) -> int:
+        return len(self.send_buffer) + self.cur_window
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        self.high_water = high if high is not None else 4 * RECV_WINDOW
+        self.low_water = low if low is not None else self.high_water // 4
+
+    def pause_reading(self):
+        self.reading_paused = True
+
+    def resume_reading(self):
+        if self.reading_paused:
+            self.reading_paused = False
+            # Window update
+            self.send_ack()
+
+    def is_reading(self) -> bool:
+        return not self.reading_paused
+
+    def close(self):
+        if self.is_closing():
+            return
+        self.closing = True
+        self.flush()
+
+    def abort(self):
+        if not self.closed:
+            self.send(Packet(PacketType.RESET, self.send_id, self.seq_nr, self.ack_nr))
+            self.finish(None)
+
+    # Sender
+
+    def send(self, packet: Packet):
+        packet.timestamp = now_us()
+        packet.timestamp_difference = self.reply_micro
+        packet.wnd_size = 0 if self.reading_paused else max(0, RECV_WINDOW - len(self.reorder) * PACKET_SIZE)
+        packet.ack_nr = self.ack_nr
+        self.socket.sendto(packet.to_bytes(), self.addr)
+
+    def send_new(self, type: PacketType, payload: bytes=b""):
+        packet = Packet(type, self.send_id if type != PacketType.SYN else self.recv_id, self.seq_nr, self.ack_nr, payload=payload)
+        out = self.in_flight[self.seq_nr] = OutPacket(packet)
+        self.seq_nr = (self.seq_nr + 1) & 0xFFFF
+        self.cur_window += len(payload)
+        self.transmit(out)
+
+    def transmit(self, out: OutPacket):
+        out.sent_at = time.monotonic()
+        out.transmissions += 1
+        self.send(out.packet)
+        if self.timer is None:
+            self.timer = self.loop.call_later(self.timeout, self.timed_out)
+
+    def flush(self):
+        self.flush_scheduled = False
+        if self.closed:
+            return
+        window = min(self.max_window, self.peer_wnd)
+        if self.resends:
+            for out in [o for o in self.in_flight.values() if o.need_resend]:
+                if self.cur_window and self.cur_window + len(out.packet.payload) > window:
+                    break
+                out.need_resend = False
+                self.resends -= 1
+                self.cur_window += len(out.packet.payload)
+                self.transmit(out)
+        while self.send_buffer and not self.resends and (not self.cur_window or self.cur_window + min(PACKET_SIZE, len(self.send_buffer)) <= window):
+            payload = bytes(self.send_buffer[:PACKET_SIZE])
+            del self.send_buffer[:PACKET_SIZE]
+            self.send_new(PacketType.DATA, payload)
+        if self.writing_paused and len(self.send_buffer) <= self.low_water:
+            self.writing_paused = False
+            self.protocol.resume_writing()
+        if self.closing and not self.send_buffer and self.fin_seq is None and self.connected.done():
+            self.fin_seq = self.seq_nr
+            self.send_new(PacketType.FIN)
+        if self.send_buffer and self.peer_wnd == 0 and self.timer is None:
+            # Zero window probe, the window update may have been lost
+            self.timer = self.loop.call_later(self.timeout, self.timed_out)
+
+    def restart_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if self.in_flight:
+            self.timer = self.loop.call_later(self.timeout, self.timed_out)
+
+    def timed_out(self):
+        self.timer = None
+        self.retries += 1
+        if self.retries > MAX_RETRIES:
+            log.info("uTP connection to {} timed out", self.addr)
+            error = ConnectionAbortedError(f"uTP connection to {self.addr[0]}:{self.addr[1]} timed out")
+            self.socket.sendto(Packet(PacketType.RESET, self.send_id, self.seq_nr, self.ack_nr).to_bytes(), self.addr)
+            self.finish(error)
+            return
+        self.timeout *= 2
+        if not self.in_flight:
+            self.peer_wnd = PACKET_SIZE
+            self.flush()
+            return
+        self.max_window = MIN_WINDOW
+        self.slow_start = False
+        # Everything in flight is presumed lost and sent again as the window allows
+        for out in self.in_flight.values():
+            if not out.need_resend:
+                out.need_resend = True
+                self.resends += 1
+                self.cur_window -= len(out.packet.payload)
+        self.flush()
+
+    def update_rtt(self, sample: float):
+        if self.rtt is None:
+            self.rtt, self.rtt_var = sample, sample / 2
+        else:
+            self.rtt_var += (abs(self.rtt - sample) - self.rtt_var) / 4
+            self.rtt += (sample - self.rtt) / 8
+        self.timeout = max(self.rtt + 4 * self.rtt_var, MIN_TIMEOUT)
+
+    def base_delay(self, sample: int) -> int:
+        minute = int(time.monotonic() // 60)
+        if self.base_delays and self.base_delays[-1][0] == minute:
+            if sample < self.base_delays[-1][1]:
+                self.base_delays[-1] = (minute, sample)
+        else:
+            self.base_delays.append((minute, sample))
+            while self.base_delays[0][0] <= minute - BASE_DELAY_HISTORY:
+                self.base_delays.popleft()
+        return min(d for _,d in self.base_delays)
+
+    def congestion_control(self, bytes_acked: int, delay: int):
+        our_delay = delay - self.base_delay(delay)
+        off_target = (CCONTROL_TARGET - our_delay) / CCONTROL_TARGET
+        if self.slow_start and off_target > 0:
+            self.max_window += bytes_acked
+            return
+        self.slow_start = False
+        window_factor = min(bytes_acked, self.max_window) / max(self.max_window, bytes_acked)
+        self.max_window = max(MIN_WINDOW, self.max_window + MAX_CWND_INCREASE_BYTES_PER_RTT * off_target * window_factor)
+
+    def acked(self, seq: int, now: float) -> int:
+        out = self.in_flight.pop(seq)
+        if out.need_resend:
+            self.resends -= 1
+        else:
+            self.cur_window -= len(out.packet.payload)
+        if out.transmissions == 1:
+            self.update_rtt(now - out.sent_at)
+        if out.packet.type == PacketType.SYN and not self.connected.done():
+            self.connected.set_result(None)
+        return len(out.packet.payload)
+
+    def ack_received(self, packet: Packet):
+        now = time.monotonic()
+        bytes_acked = 0
+        for seq in list(self.in_flight):
+            if seq_diff(packet.ack_nr, seq) < 0:
+                break
+            bytes_acked += self.acked(seq, now)
+        sacked = 0
+        if packet.sack:
+            for i in range(len(packet.sack) * 8):
+                if packet.sack[i // 8] >> (i % 8) & 1:
+                    sacked += 1
+                    if (seq := (packet.ack_nr + 2 + i) & 0xFFFF) in self.in_flight:
+                        bytes_acked += self.acked(seq, now)
+        if bytes_acked or packet.ack_nr != self.last_ack:
+            self.retries = 0
+            self.dup_acks = 0
+            if self.rtt is not None:
+                self.timeout = max(self.rtt + 4 * self.rtt_var, MIN_TIMEOUT)
+            self.restart_timer()
+        elif self.in_flight and packet.type == PacketType.STATE:
+            self.dup_acks += 1
+        self.last_ack = packet.ack_nr
+        if bytes_acked and packet.timestamp_difference:
+            self.congestion_control(bytes_acked, packet.timestamp_difference)
+        lost = (packet.ack_nr + 1) & 0xFFFF
+        if (self.dup_acks >= 3 or sacked >= 3) and lost in self.in_flight and not self.in_flight[lost].need_resend and self.fast_resend_seq != lost:
+            # Packet loss, at most one back off per lost packet
+            self.fast_resend_seq = lost
+            self.max_window = max(MIN_WINDOW, self.max_window / 2)
+            self.slow_start = False
+            self.transmit(self.in_flight[lost])
+        if self.fin_seq is not None and self.fin_seq not in self.in_flight and not self.lost:
+            if self.eof_seq is not None:
+                self.finish(None)
+                return
+            # Done as far as the protocol is concerned, linger to acknowledge the FIN of the other side
+            self.connection_lost(None)
+            self.loop.call_later(4 * self.timeout, self.finish, None)
+
+    # Receiver
+
+    def schedule_ack(self):
+        # Acks are coalesced over the datagrams handled in one loop iteration
+        if not self.ack_scheduled:
+            self.ack_scheduled = True
+            self.loop.call_soon(self.send_ack)
+
+    def send_ack(self):
+        self.ack_scheduled = False
+        if self.closed:
+            return
+        sack = None
+        # Bit i acknowledges ack_nr + 2 + i, in 32 bits words
+        if offsets := [i for seq in self.reorder if 0 <= (i := seq_diff(seq, self.ack_nr) - 2) < 256]:
+            bits = bytearray(4 * (max(offsets) // 32 + 1))
+            for i in offsets:
+                bits[i // 8] |= 1 << (i % 8)
+            sack = bytes(bits)
+        self.send(Packet(PacketType.STATE, self.send_id, self.seq_nr, self.ack_nr, sack=sack))
+
+    def data_received(self, packet: Packet):
+        distance = seq_diff(packet.seq_nr, self.ack_nr)
+        if distance <= 0 or distance * PACKET_SIZE > 2 * RECV_WINDOW:
+            # Duplicate, its ack was probably lost
+            self.schedule_ack()
+            return
+        self.reorder[packet.seq_nr] = packet
+        while (packet := self.reorder.pop((self.ack_nr + 1) & 0xFFFF, None)) is not None:
+            self.ack_nr = packet.seq_nr
+            if packet.type == PacketType.FIN:
+                self.eof_seq = packet.seq_nr
+                self.reorder.clear()
+                if self.lost:
+                    self.send_ack()
+                    self.finish(None)
+                    return
+                self.protocol.eof_received()
+                break
+            if packet.payload and not self.lost:
+                self.protocol.data_received(packet.payload)
+        self.schedule_ack()
+
+    def packet_received(self, packet: Packet):
+        self.reply_micro = (now_us() - packet.timestamp) & 0xFFFFFFFF
+        self.peer_wnd = packet.wnd_size
+        match packet.type:
+            case PacketType.RESET:
+                self.finish(ConnectionResetError(f"uTP connection reset by {self.addr[0]}:{self.addr[1]}"))
+                return
+            case PacketType.STATE if not self.connected.done():
+                # The first data packet of the other side uses the sequence number of its SYN acknowledgement
+                self.ack_nr = (packet.seq_nr - 1) & 0xFFFF
+            case PacketType.SYN:
+                # Our acknowledgement of the SYN was lost
+                self.schedule_ack()
+                return
+        self.ack_received(packet)
+        if self.closed:
+            return
+        if packet.type in (PacketType.DATA, PacketType.FIN) and self.eof_seq is None:
+            self.data_received(packet)
+        elif packet.type in (PacketType.DATA, PacketType.FIN):
+            self.schedule_ack()
+        self.flush()
+
+    def finish(self, exc: Exception|None):
+        if self.closed:
+            return
+        self.closed = True
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.socket.unregister(self)
+        self.connection_lost(exc)
+
+    def connection_lost(self, exc: Exception|None):
+        if self.lost:
+            return
+        self.lost = True
+        if not self.connected.done():
+            self.connected.set_exception(exc or ConnectionResetError("uTP connection closed"))
+        elif not self.connected.cancelled():
+            self.protocol.connection_lost(exc)
+
+
+class UtpSocket(asyncio.DatagramProtocol):
+    def __init__(self, loss: float=0.0, delay: float=0.0, jitter: float=0.0) -> None:
+        # Simulated link, applied to every datagram sent
+        self.loss = loss
+        self.delay = delay
+        self.jitter = jitter
+        self.transport: asyncio.DatagramTransport|None = None
+        self.connections: dict[tuple[tuple[str,int],int],UtpConnection] = {}
+        self.accept: Callable[[asyncio.StreamReader,asyncio.StreamWriter],object]|None = None
+
+    @classmethod
+    async def bind(cls, host: str="127.0.0.1", port: int|None=None, loss: float=0.0, delay: float=0.0, jitter: float=0.0) -> Self:
+        loop = asyncio.get_running_loop()
+        transport, sock = await loop.create_datagram_endpoint(lambda: cls(loss, delay, jitter), local_addr=(host, port or 0))
+        # Every connection shares these buffers
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            transport.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER)
+        return sock
+
+    @property
+    def sockname(self) -> tuple[str,int]:
+        assert self.transport is not None
+        return self.transport.get_extra_info("sockname")
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        for conn in list(self.connections.values()):
+            conn.finish(exc or ConnectionAbortedError("uTP socket closed"))
+
+    def sendto(self, data: bytes, addr: tuple[str,int]):
+        if self.transport is None or self.transport.is_closing():
+            return
+        if self.loss and random.random() < self.loss:
+            return
+        if self.delay or self.jitter:
+            asyncio.get_running_loop().call_later(self.delay + random.uniform(0, self.jitter), self.sendto_now, data, addr)
+        else:
+            self.transport.sendto(data, addr)
+
+    def sendto_now(self, data: bytes, addr: tuple[str,int]):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.sendto(data, addr)
+
+    def unregister(self, conn: UtpConnection):
+        if self.connections.get((conn.addr, conn.recv_id)) is conn:
+            del self.connections[(conn.addr, conn.recv_id)]
+
+    def datagram_received(self, data: bytes, addr: tuple[str,int]):
+        try:
+            packet = Packet.from_bytes(data)
+        except ValueError:
+            return
+        addr = addr[:2]
+        if packet.type == PacketType.SYN:
+            # Retransmitted SYNs go to the connection they opened
+            if (conn := self.connections.get((addr, (packet.connection_id + 1) & 0xFFFF))) is not None:
+                conn.packet_received(packet)
+            else:
+                self.syn_received(packet, addr)
+            return
+        if (conn := self.connections.get((addr, packet.connection_id))) is not None:
+            conn.packet_received(packet)
+        elif packet.type != PacketType.RESET:
+            self.sendto(Packet(PacketType.RESET, packet.connection_id, 0, packet.seq_nr).to_bytes(), addr)
+
+    def syn_received(self, packet: Packet, addr: tuple[str,int]):
+        if self.accept is None:
+            self.sendto(Packet(PacketType.RESET, packet.connection_id, 0, packet.seq_nr).to_bytes(), addr)
+            return
+        reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(reader, self.accept)
+        conn = UtpConnection(self, addr, (packet.connection_id + 1) & 0xFFFF, packet.connection_id, protocol)
+        conn.seq_nr = random.randint(0, 0xFFFF)
+        conn.ack_nr = packet.seq_nr
+        conn.connected.set_result(None)
+        self.connections[(addr, conn.recv_id)] = conn
+        conn.packet_received(packet)
+        protocol.connection_made(conn)
+
+    def serve(self, client_connected_cb: Callable[[asyncio.StreamReader,asyncio.StreamWriter],object]):
+        self.accept = client_connected_cb
+
+    async def open_connection(self, host: str, port: int) -> tuple[asyncio.StreamReader,asyncio.StreamWriter]:
+        loop = asyncio.get_running_loop()
+        addr = (host, port)
+        recv_id = random.randint(0, 0xFFFF)
+        while (addr, recv_id) in self.connections:
+            recv_id = random.randint(0, 0xFFFF)
+        reader = asyncio.StreamReader()
+        protocol = asyncio.StreamReaderProtocol(reader)
+        conn = UtpConnection(self, addr, recv_id, (recv_id + 1) & 0xFFFF, protocol)
+        self.connections[(addr, recv_id)] = conn
+        conn.send_new(PacketType.SYN)
+        try:
+            await conn.connected
+        except asyncio.CancelledError:
+            conn.finish(None)
+            raise
+        protocol.connection_made(conn)
+        return reader, asyncio.StreamWriter(conn, protocol, reader, loop)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
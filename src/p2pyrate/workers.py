@@ -0,0 +1,396 @@
+from typing import (
+    Iterable,
+    Self,
+)
+from enum import IntEnum
+from hashlib import sha1
+from multiprocessing.connection import Connection
+from multiprocessing.shared_memory import SharedMemory
+import asyncio
+import gc
+import multiprocessing as mp
+import os
+import socket
+import struct
+import sys
+
+from loguru import logger as log
+
+from .files import FileIndex, Priority
+from .metadata import Metadata, TorrentFile
+from .downloader import Downloader, Event, CompletePiece, random_peer_id
+from .peer.peer import Peer
+from .picker import PiecePicker
+
+
+class IPC(IntEnum):
+    CONNECT = 0     # central -> worker: port, host
+    AVAILABLE = 1   # worker -> central: piece indices announced by one of its peers
+    UNAVAILABLE = 2 # worker -> central: piece indices of a peer that went away
+    WANT = 3        # worker -> central: number of pieces it can take
+    ASSIGN = 4      # central -> worker: piece indices it should download
+    RELEASE = 5     # worker -> central: assigned piece indices none of its peers has
+    DONE = 6        # worker -> central: piece index written to storage and verified
+    HAVE = 7        # central -> worker: piece indices verified by any worker
+    STOP = 8        # central -> worker
+    READY = 9       # worker -> central: listening and accepting IPC
+
+
+def encode(kind: IPC, values: Iterable[int]=()) -> bytes:
+    values = list(values)
+    return struct.pack(f"!B{len(values)}I", kind, *values)
+
+
+def decode(buf: bytes) -> tuple[IPC,tuple[int,...]]:
+    return IPC(buf[0]), struct.unpack(f"!{(len(buf)-1)//4}I", buf[1:])
+
+
+def encode_connect(host: str, port: int) -> bytes:
+    return struct.pack("!BH", IPC.CONNECT, port) + host.encode()
+
+
+def decode_connect(buf: bytes) -> tuple[str,int]:
+    return buf[3:].decode(), struct.unpack("!H", buf[1:3])[0]
+
+
+class Channel:
+    # Connection.send_bytes blocks once the pipe is full, two processes doing it towards each other from
+    # their event loops deadlock. The pipe is driven by asyncio instead and writes are only buffered.
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def open(cls, conn: Connection) -> Self:
+        sock = socket.socket(fileno=os.dup(conn.fileno()))
+        conn.close()
+        return cls(*await asyncio.open_unix_connection(sock=sock))
+
+    def send(self, buf: bytes):
+        if not self.writer.is_closing():
+            self.writer.write(struct.pack("!I", len(buf)) + buf)
+
+    async def recv(self) -> bytes|None:
+        try:
+            header = await self.reader.readexactly(4)
+            return await self.reader.readexactly(struct.unpack("!I", header)[0])
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+    def close(self):
+        self.writer.close()
+
+
+def attach_shared_memory(name: str) -> SharedMemory:
+    if sys.version_info >= (3, 13):
+        return SharedMemory(name=name, track=False)
+    from multiprocessing import resource_tracker
+    shm = SharedMemory(name=name)
+    # The central process owns the segment, do not let the worker's tracker unlink it
+    resource_tracker.unregister(shm._name, "shared_memory") # type: ignore
+    return shm
+
+
+class Worker(Downloader):
+    def __init__(self, metadata: Metadata, peer_id: bytes, storage: memoryview, conn: Connection, have: list[bool]) -> None:
+        super().__init__(metadata, peer_id=peer_id, storage=storage)
+        self.conn = conn
+        self.channel: Channel|None = None
+        self.assigned: set[int] = set()
+        self.wanting: bool = False
+        self.stopped = asyncio.Event()
+        self.tasks: set[asyncio.Task] = set()
+        for piece,h in zip(self.pieces, have):
+            if h:
+                piece.mark_complete()
+
+    @property
+    def capacity(self) -> int:
+        return self.max_requested_pieces * max(1, len(self.peers)) - len(self.assigned)
+
+    def send(self, kind: IPC, values: Iterable[int]=()):
+        if not self.stopped.is_set() and self.channel is not None:
+            self.channel.send(encode(kind, values))
+
+    def spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.task_done)
+
+    def task_done(self, task: asyncio.Task):
+        self.tasks.discard(task)
+        if not task.cancelled() and (e := task.exception()) is not None:
+            log.opt(exception=e).warning("worker task failed")
+
+    def ask(self):
+        if not self.wanting and self.capacity > 0:
+            self.wanting = True
+            self.send(IPC.WANT, [self.capacity])
+
+    def wanted(self, index: int) -> bool:
+        return index in self.assigned and not self.pieces[index].complete
+
+    def peer_has(self, peer: Peer, indices: list[int]):
+        new = [i for i in indices if i not in peer.pieces]
+        super().peer_has(peer, indices)
+        if new:
+            self.send(IPC.AVAILABLE, new)
+            self.ask()
+
+    def peer_closed(self, peer: Peer):
+        super().peer_closed(peer)
+        if peer.pieces:
+            self.send(IPC.UNAVAILABLE, peer.pieces)
+        orphans = [i for i in self.assigned if not any(i in p.pieces for p in self.peers.values())]
+        if orphans:
+            self.assigned.difference_update(orphans)
+            self.send(IPC.RELEASE, orphans)
+
+    async def piece_completed(self, index: int):
+        # Verification happens in the worker so hashing scales with the workers too
+        if not self.pieces[index].verify():
+            log.warning("hash mismatch for piece {}", index)
+            self.pieces[index].reset()
+            self.picker.release([index])
+            return
+        self.assigned.discard(index)
+        self.send(IPC.DONE, [index])
+
+    async def request_assigned(self):
+        for peer in list(self.peers.values()):
+            await self.update_interest(peer)
+            await self.request_pieces(peer)
+
+    async def connect(self, host: str, port: int, retries: int=5):
+        for attempt in range(retries):
+            try:
+                return await self.add_peer(host, port)
+            except ConnectionRefusedError:
+                await asyncio.sleep(0.2 * 2**attempt)
+        log.warning("could not connect to {}:{}", host, port)
+
+    async def read_ipc(self, channel: Channel):
+        while (buf := await channel.recv()) is not None:
+            self.on_ipc(buf)
+        self.stopped.set()
+
+    def on_ipc(self, buf: bytes):
+        if buf[0] == IPC.CONNECT:
+            self.spawn(self.connect(*decode_connect(buf)))
+            return
+        kind, values = decode(buf)
+        match kind:
+            case IPC.ASSIGN:
+                self.wanting = False
+                self.assigned.update(values)
+                self.spawn(self.request_assigned())
+            case IPC.HAVE:
+                for index in values:
+                    self.pieces[index].mark_complete()
+                    self.picker.mark_have(index)
+                    self.assigned.discard(index)
+                    self.event_q.put_nowait(Event(peer_id=self.peer_id, message=CompletePiece(index=index)))
+                self.ask()
+            case IPC.STOP:
+                self.stopped.set()
+            case _:
+                raise ValueError(f"unexpected IPC message {kind}")
+
+    async def serve_events(self):
+        # handle_events returns whenever the torrent is complete, keep seeding
+        while True:
+            await self.handle_events()
+
+    async def run(self, port: int|None):
+        self.channel = await Channel.open(self.conn)
+        self.spawn(self.read_ipc(self.channel))
+        self.spawn(self.serve_events())
+        if port is not None:
+            server = await self.listen(port, reuse_port=True)
+            self.spawn(server.serve_forever())
+        self.send(IPC.READY)
+        await self.stopped.wait()
+        for task in list(self.tasks):
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        if self.channel is not None:
+            self.channel.close()
+
+
+def _worker_main(metadata: Metadata, peer_id: bytes, shm_name: str, have: list[bool], conn: Connection, port: int|None, log_level: str):
+    log.remove()
+    log.add(sys.stderr, level=log_level)
+    shm = attach_shared_memory(shm_name)
+    worker = Worker(metadata, peer_id, shm.buf[:metadata.info.total_length], conn, have)
+    asyncio.run(worker.run(port))
+    # Drop the piece views before detaching from the segment
+    del worker
+    gc.collect()
+    shm.close()
+
+
+class Coordinator:
+    def __init__(self, metadata: Metadata, workers: int|None=None, peer_id: bytes|None=None, log_level: str="INFO") -> None:
+        self.metadata = metadata
+        self.n_workers: int = workers or os.cpu_count() or 1
+        self.peer_id: bytes = peer_id or random_peer_id()
+        self.log_level = log_level
+        info = metadata.info
+        self.piece_length: int = info.piece_length
+        self.total_length: int = info.total_length
+        self.hashes: list[bytes] = info.pieces
+        self.file_index = FileIndex(info)
+        self.picker = PiecePicker(len(self.hashes))
+        self.picker.priority = list(self.file_index.piece_priorities())
+        self.shm = SharedMemory(create=True, size=max(1, self.total_length))
+        self.channels: list[Channel] = []
+        self.readers: list[asyncio.Task] = []
+        self.procs: list[mp.Process] = []
+        self.availability: list[list[int]] = []
+        # Workers whose last WANT was not met in full, and how many more pieces they can take
+        self.unmet: dict[int,int] = {}
+        self.next_worker: int = 0
+        self.ready: int = 0
+        self.workers_ready = asyncio.Event()
+        self.completed = asyncio.Event()
+        self.error: Exception|None = None
+        self.closed = asyncio.Event()
+
+    def worker_peer_id(self, w: int) -> bytes:
+        # Peers tell connections apart by peer id, two workers reaching the same peer must not collide
+        return self.peer_id[:-4] + f"{w:04}".encode()
+
+    def set_complete_data(self, index: int, data: bytes):
+        assert sha1(data).digest()==self.hashes[index]
+        start = index*self.piece_length
+        self.shm.buf[start:start+len(data)] = data
+        self.picker.mark_have(index)
+        self.broadcast(IPC.HAVE, [index])
+
+    def set_file_priorities(self, priorities: dict[int|TorrentFile,Priority]):
+        # Pieces already assigned to a worker are still downloaded
+        for index in self.file_index.set_priorities(priorities):
+            self.picker.priority[index] = self.file_index.piece_priority(index)
+        if self.workers_ready.is_set() and self.picker.complete:
+            self.completed.set()
+
+    def assign(self, w: int, n: int, candidates: Iterable[int]) -> list[int]:
+        picked = self.picker.pick(w, candidates, n)
+        if len(picked) < n:
+            self.unmet[w] = n - len(picked)
+        else:
+            self.unmet.pop(w, None)
+        return picked
+
+    def offer(self, indices: Iterable[int]):
+        # Workers only ask again when they learn about new pieces, released ones are handed to those left waiting
+        indices = list(indices)
+        for w,n in list(self.unmet.items()):
+            candidates = [i for i in indices if self.availability[w][i]]
+            if candidates and (picked := self.assign(w, n, candidates)):
+                self.channels[w].send(encode(IPC.ASSIGN, picked))
+
+    def broadcast(self, kind: IPC, values: Iterable[int]):
+        buf = encode(kind, values)
+        for channel in self.channels:
+            channel.send(buf)
+
+    async def start_workers(self, port: int|None=None):
+        ctx = mp.get_context("spawn")
+        have = [i in self.picker.have for i in range(len(self.hashes))]
+        for w in range(self.n_workers):
+            conn, child = ctx.Pipe()
+            proc = ctx.Process(
+                target=_worker_main,
+                args=(self.metadata, self.worker_peer_id(w), self.shm.name, have, child, port, self.log_level),
+                daemon=True,
+            )
+            proc.start()
+            child.close()
+            self.channels.append(channel := await Channel.open(conn))
+            self.procs.append(proc) # type: ignore
+            self.availability.append([0] * len(self.hashes))
+            self.readers.append(asyncio.create_task(self.read_ipc(w, channel)))
+        await self.workers_ready.wait()
+        if self.error is not None:
+            raise self.error
+        if self.picker.complete:
+            self.completed.set()
+
+    async def add_peer(self, host: str, port: int):
+        # Outbound connections are spread round robin, inbound ones by the kernel through SO_REUSEPORT
+        self.channels[self.next_worker].send(encode_connect(host, port))
+        self.next_worker = (self.next_worker + 1) % self.n_workers
+
+    async def read_ipc(self, w: int, channel: Channel):
+        while (buf := await channel.recv()) is not None:
+            self.on_ipc(w, buf)
+        self.worker_lost(w)
+
+    def worker_lost(self, w: int):
+        # Workers only exit on STOP, the pipe closing first means the process died
+        log.error("worker {} (pid {}) exited unexpectedly", w, self.procs[w].pid)
+        self.channels[w].close()
+        self.unmet.pop(w, None)
+        for i,count in enumerate(self.availability[w]):
+            self.picker.availability[i] -= count
+        self.availability[w] = [0] * len(self.hashes)
+        self.offer(self.picker.release_owner(w))
+        # Its peers are gone with it, the download cannot be trusted to finish
+        self.error = RuntimeError(f"worker {w} exited unexpectedly")
+        self.workers_ready.set()
+        self.completed.set()
+
+    def on_ipc(self, w: int, buf: bytes):
+        kind, values = decode(buf)
+        match kind:
+            case IPC.AVAILABLE:
+                self.picker.add_available(values)
+                for i in values:
+                    self.availability[w][i] += 1
+            case IPC.UNAVAILABLE:
+                self.picker.add_available(values, delta=-1)
+                for i in values:
+                    self.availability[w][i] -= 1
+            case IPC.WANT:
+                candidates = [i for i,count in enumerate(self.availability[w]) if count]
+                self.channels[w].send(encode(IPC.ASSIGN, self.assign(w, values[0], candidates)))
+            case IPC.RELEASE:
+                self.picker.release(values)
+                self.offer(values)
+            case IPC.DONE:
+                for i in values:
+                    self.picker.mark_have(i)
+                self.broadcast(IPC.HAVE, values)
+                if self.picker.complete:
+                    self.completed.set()
+            case IPC.READY:
+                self.ready += 1
+                if self.ready == self.n_workers:
+                    self.workers_ready.set()
+            case _:
+                raise ValueError(f"unexpected IPC message {kind}")
+
+    async def handle_events(self):
+        await self.completed.wait()
+        if self.error is not None:
+            raise self.error
+
+    async def start(self, port: int|None=None):
+        await self.start_workers(port)
+        await self.closed.wait()
+
+    def close(self):
+        for task in self.readers:
+            task.cancel()
+        # Workers also stop when their pipe closes, should the STOP still be buffered
+        for channel in self.channels:
+            channel.send(encode(IPC.STOP))
+            channel.close()
+        for proc in self.procs:
+            proc.join(timeout=5)
+            if proc.is_alive():
+                proc.kill()
+        self.shm.close()
+        self.shm.unlink()
+        self.closed.set()